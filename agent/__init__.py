@@ -1,2 +1,3 @@
 from .base_agent import Agent
 
+from .history import HistoryManager
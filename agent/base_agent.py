@@ -3,26 +3,92 @@
 
 import os
 import sys
+import time
+import queue
 import datetime
 import hashlib
 import logging
+import re
 import json
-from typing import Iterator
+import threading
+import contextvars
+from typing import Iterator, Union
 
 from langchain_core.messages import (
     BaseMessage,
     HumanMessage,
     SystemMessage,
     BaseMessageChunk,
+    AIMessageChunk,
 )
 from langchain.output_parsers.json import parse_json_markdown
 from langchain_openai import ChatOpenAI
+from utils.rate_limit import get_limiter
+from utils.tokens import count_tokens
+
+
+_STREAM_END = object()
+_JSON_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"\s*")
+
+
+def parse_json_keys(text: str, keys: set[str]) -> Union[dict, None]:
+    """Parse the top-level members of a possibly incomplete JSON object.
+
+    Members are decoded in order until the text runs out, so a member counts
+    only once its value is complete. Numbers at the very end of the text are
+    not accepted yet, as more digits may follow.
+
+    Args:
+        text: Model output so far, anything before the first "{" is skipped.
+        keys: Keys that must be complete.
+
+    Returns:
+        The members parsed so far once all keys are complete, otherwise None.
+    """
+    i = text.find("{")
+    if i < 0:
+        return None
+    i += 1
+    found = {}
+    while True:
+        i = _WHITESPACE.match(text, i).end()
+        if i >= len(text) or text[i] == "}":
+            return None
+        if text[i] == ",":
+            i += 1
+            continue
+        try:
+            key, i = _JSON_DECODER.raw_decode(text, i)
+        except ValueError:
+            return None
+        i = _WHITESPACE.match(text, i).end()
+        if not isinstance(key, str) or i >= len(text) or text[i] != ":":
+            return None
+        i = _WHITESPACE.match(text, i + 1).end()
+        try:
+            value, end = _JSON_DECODER.raw_decode(text, i)
+        except ValueError:
+            return None
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and end >= len(text):
+            return None
+        found[key] = value
+        i = end
+        if keys.issubset(found):
+            return found
 
 
 class Agent:
     def __init__(self, prompt="", name="", log_level=logging.INFO, **model_args):
         self.prompt = prompt
         self.log_level = log_level
+        self.first_token_timeout = float(
+            model_args.pop("first_token_timeout", os.getenv("LLM_FIRST_TOKEN_TIMEOUT", 0))
+        )
+        self.inter_token_timeout = float(
+            model_args.pop("inter_token_timeout", os.getenv("LLM_INTER_TOKEN_TIMEOUT", 0))
+        )
+        fallback_model = model_args.pop("fallback_model", os.getenv("LLM_FALLBACK_MODEL"))
         if not name:
             self.name = f"Agent-{hashlib.md5(self.prompt.encode()).hexdigest()}"
 
@@ -37,22 +103,53 @@ class Agent:
         self.usage_logger.setLevel(self.log_level)
         self.usage_logger.addHandler(logging.FileHandler(f"logs/usage.{self.name}.log"))
 
+        model_name = model_args.pop("llm_model", os.getenv("LLM_MODEL", "qwen-plus"))
+        api_key = model_args.pop("llm_api_key", os.getenv("API_KEY"))
+        base_url = model_args.pop(
+            "llm_base_url",
+            os.getenv(
+                "LLM_BASE_URL",
+                "https://dashscope.aliyuncs.com/compatible-mode/v1",
+            ),
+        )
+        if self.first_token_timeout > 0 and "timeout" not in model_args:
+            # The consumer gives up on a silent stream after two first-token deadlines or one inter-token
+            # deadline, the read timeout ends an abandoned stream and frees its connection about as soon.
+            # Without a first-token deadline the first token may take arbitrarily long, so no timeout is set.
+            model_args["timeout"] = max(2 * self.first_token_timeout, self.inter_token_timeout)
+            # Hedging already retries a failed request, client retries would only keep abandoned requests alive.
+            model_args.setdefault("max_retries", 0)
         self.model = ChatOpenAI(
-            model=model_args.pop("llm_model", os.getenv("LLM_MODEL", "qwen-plus")),
+            model=model_name,
             temperature=0.2,
             max_tokens=2000,
-            api_key=model_args.pop("llm_api_key", os.getenv("API_KEY")),
-            base_url=model_args.pop(
-                "llm_base_url",
-                os.getenv(
-                    "LLM_BASE_URL",
-                    "https://dashscope.aliyuncs.com/compatible-mode/v1",
-                ),
-            ),
+            api_key=api_key,
+            base_url=base_url,
+            stream_usage=True,
             **model_args,
         )
+        # The hedged request goes to the fallback model, or to the same model when none is configured.
+        # It is only built once a deadline is hit.
+        self.__hedge_args = dict(
+            model=fallback_model or model_name,
+            temperature=0.2,
+            max_tokens=2000,
+            api_key=api_key,
+            base_url=base_url,
+            stream_usage=True,
+            **model_args,
+        )
+        self.__hedge_model = None
+        self.__hedge_lock = threading.Lock()
 
-    def __invoke(self, query: str, history=None, stream=False, **prompt_kwargs) -> str:
+    @property
+    def hedge_model(self) -> ChatOpenAI:
+        with self.__hedge_lock:
+            if self.__hedge_model is None:
+                self.__hedge_model = ChatOpenAI(**self.__hedge_args)
+            return self.__hedge_model
+
+    def __messages(self, query: str, history=None, **prompt_kwargs) -> list:
         if history is None:
             history: list = []
 
@@ -63,14 +160,124 @@ class Agent:
         messages.append(HumanMessage(query))
 
         self.logger.debug(f"{self.name} __invoke messages: {messages}")
+        return messages
 
+    def __invoke(self, query: str, history=None, stream=False, **prompt_kwargs) -> str:
+        messages = self.__messages(query, history, **prompt_kwargs)
+
+        if self.first_token_timeout > 0 or self.inter_token_timeout > 0:
+            chunks = self.__hedged_stream(messages)
+            if stream:
+                return chunks
+            msg = AIMessageChunk(content="")
+            for chunk in chunks:
+                msg += chunk
+            return msg
+
+        self.__admit(messages)
         if stream:
             return self.model.stream(messages)
         return self.model.invoke(messages)
 
+    @staticmethod
+    def __admit(messages: list):
+        """Wait for the shared LLM rate limiter, charging the estimated prompt tokens."""
+        limiter = get_limiter("llm")
+        if limiter.unlimited:
+            return
+        tokens = sum(
+            count_tokens(str(msg.content if isinstance(msg, BaseMessage) else msg.get("content", "")))
+            for msg in messages
+        )
+        limiter.acquire(tokens)
+
+    def __hedged_stream(self, messages: list) -> Iterator[BaseMessageChunk]:
+        """Stream with first-token and inter-token deadlines.
+
+        If no token arrives within `first_token_timeout`, a duplicate request is
+        sent to the hedge model. The first stream that produces a token wins and
+        the other one is closed at its next chunk, or by the request timeout
+        derived from the deadlines if it stalls. `inter_token_timeout` bounds
+        the gap between two chunks of the winning stream.
+        """
+        events = queue.Queue()
+        cancelled = [threading.Event(), threading.Event()]
+
+        def produce(idx: int, model: ChatOpenAI):
+            stream = None
+            try:
+                self.__admit(messages)
+                stream = model.stream(messages)
+                for chunk in stream:
+                    if cancelled[idx].is_set():
+                        break
+                    events.put((idx, chunk))
+                events.put((idx, _STREAM_END))
+            except Exception as e:
+                events.put((idx, e))
+            finally:
+                # Closing the stream releases its connection right away instead of at garbage collection.
+                if stream is not None:
+                    stream.close()
+
+        def launch(idx: int, model: ChatOpenAI):
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(produce, idx, model), daemon=True).start()
+
+        launch(0, self.model)
+        started, failed, winner = 1, set(), None
+        deadline = time.monotonic() + self.first_token_timeout if self.first_token_timeout > 0 else None
+        try:
+            while True:
+                if winner is None:
+                    timeout = max(deadline - time.monotonic(), 0) if deadline is not None else None
+                else:
+                    timeout = self.inter_token_timeout or None
+                try:
+                    idx, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    if winner is None and started == 1:
+                        self.logger.warning(f"{self.name} no token in {self.first_token_timeout}s, hedging")
+                        launch(1, self.hedge_model)
+                        started += 1
+                        deadline = time.monotonic() + self.first_token_timeout
+                        continue
+                    raise TimeoutError(f"{self.name} LLM stream stalled")
+
+                if winner is not None and idx != winner:
+                    continue
+                if isinstance(item, Exception):
+                    failed.add(idx)
+                    if winner is None and started == 1:
+                        self.logger.warning(f"{self.name} stream error: {item}, hedging")
+                        launch(1, self.hedge_model)
+                        started += 1
+                        continue
+                    if winner is None and len(failed) < started:
+                        continue
+                    raise item
+                if item is _STREAM_END:
+                    if winner is None and len(failed) + 1 < started:
+                        # A stream that ended without any token loses to one that may still produce some.
+                        failed.add(idx)
+                        continue
+                    return
+                if winner is None:
+                    if not item.content:
+                        continue
+                    winner = idx
+                    if started > 1:
+                        self.logger.info(f"{self.name} hedged stream {idx} won")
+                yield item
+        finally:
+            for event in cancelled:
+                event.set()
+
     def __log_usage(self, msg: BaseMessage, **_):
+        usage = msg.response_metadata.get("token_usage") or getattr(msg, "usage_metadata", None) or {}
+        get_limiter("llm").consume(usage.get("completion_tokens") or usage.get("output_tokens") or 0)
         data = {
-            **msg.response_metadata["token_usage"],
+            **usage,
             "time": str(datetime.datetime.now()),
             "agent": self.name,
             "model_name": msg.response_metadata.get("model_name", "unknown")
@@ -86,13 +293,27 @@ class Agent:
         self.__log_usage(msg)
         return msg.content
 
-    def invoke_json(self, query: str, history=None, retry_count: int = 1, **kwargs) -> dict[str, any]:
+    def invoke_json(
+            self, query: str, history=None, retry_count: int = 1, keys: list[str] = None, **kwargs
+    ) -> dict[str, any]:
+        """Invoke the model and parse its output as JSON.
+
+        With `keys`, the output is streamed and parsed incrementally, and the
+        call returns as soon as the values of all keys are complete, cancelling
+        the rest of the generation. The returned dict then only holds the
+        members parsed so far.
+        """
         if history is None:
             history = []
 
         count = 0
         while count < retry_count:
             try:
+                if keys:
+                    parsed = self.__stream_json_keys(query, history, set(keys), **kwargs)
+                    if parsed is not None:
+                        return parsed
+                    continue
                 msg: BaseMessage = self.__invoke(query, history, **kwargs)
 
                 self.logger.debug(f"{self.name} invoke_json return msg: {msg}")
@@ -107,10 +328,48 @@ class Agent:
                 count += 1
         return {}
 
+    def __stream_json_keys(self, query: str, history: list, keys: set[str], **kwargs) -> Union[dict, None]:
+        chunks = self.__invoke(query, history, stream=True, **kwargs)
+        msg = AIMessageChunk(content="")
+        try:
+            for chunk in chunks:
+                msg += chunk
+                parsed = parse_json_keys(msg.content, keys)
+                if parsed is not None:
+                    self.logger.debug(f"{self.name} invoke_json early exit: {msg.content}")
+                    return parsed
+        finally:
+            # Closing the stream cancels the rest of the generation.
+            chunks.close()
+            if not msg.usage_metadata:
+                # Usage is only reported at the end of a stream, charge an estimate for a cut-off one.
+                msg.usage_metadata = {
+                    "input_tokens": 0,
+                    "output_tokens": count_tokens(msg.content),
+                    "total_tokens": count_tokens(msg.content),
+                }
+            self.__log_usage(msg)
+
+        self.logger.debug(f"{self.name} invoke_json return msg: {msg}")
+        return parse_json_markdown(msg.content)
+
     def stream(self, query: str, history=None, **kwargs) -> Iterator[BaseMessageChunk]:
         if history is None:
             history = []
-        return self.__invoke(query, history, stream=True, **kwargs)
+        return self.__track_stream_usage(self.__invoke(query, history, stream=True, **kwargs))
+
+    @staticmethod
+    def __track_stream_usage(chunks: Iterator[BaseMessageChunk]) -> Iterator[BaseMessageChunk]:
+        """Charge the completion tokens reported by a stream to the LLM rate limiter."""
+        output_tokens = 0
+        try:
+            for chunk in chunks:
+                usage = getattr(chunk, "usage_metadata", None)
+                if usage:
+                    output_tokens += usage.get("output_tokens", 0)
+                yield chunk
+        finally:
+            get_limiter("llm").consume(output_tokens)
 
 
 if __name__ == '__main__':
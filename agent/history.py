@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from agent.base_agent import Agent
+from agent.prompt import SUMMARY_PROMPT
+from utils.tokens import count_tokens
+
+SUMMARY_PREFIX = "（此前对话摘要）"
+
+
+def split_turns(history: list[dict]) -> list[list[dict]]:
+    """Group a chat history into turns, a new turn starts at every user message."""
+    turns = []
+    for msg in history:
+        if msg["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+
+class HistoryManager:
+    """
+    Chat history compaction under a token budget.
+
+    The most recent turns are kept verbatim, older turns are folded into a
+    summary. A summary is cached under the key of the last turn it covers, so
+    a new turn only summarizes the turns that dropped out of the window since
+    the last cached summary, also when the oldest turns no longer reach the
+    caller, e.g. with a history of the last N turns.
+    """
+
+    _summary_cache: OrderedDict = OrderedDict()
+    _cache_lock = threading.Lock()
+    cache_size = 512
+
+    def __init__(
+            self,
+            token_budget: int = 2000,
+            min_recent_turns: int = 1,
+            summary_ratio: float = 0.3,
+            llm_model: str = None,
+    ):
+        self.token_budget = token_budget
+        self.min_recent_turns = min_recent_turns
+        self.summary_budget = int(token_budget * summary_ratio)
+        self.llm_model = llm_model
+        self.logger = logging.getLogger(__name__)
+        self.__summary_agent = None
+
+    @staticmethod
+    def _turn_tokens(turn: list[dict]) -> int:
+        return sum(count_tokens(msg["content"]) for msg in turn)
+
+    @staticmethod
+    def _truncate(turn: list[dict], budget: int) -> list[dict]:
+        """Cut the contents of a turn proportionally so that it fits into the budget."""
+        tokens = HistoryManager._turn_tokens(turn)
+        if tokens <= budget or tokens == 0:
+            return turn
+        ratio = budget / tokens
+        return [
+            {**msg, "content": msg["content"][: int(len(msg["content"]) * ratio)]}
+            for msg in turn
+        ]
+
+    @staticmethod
+    def _format_turns(turns: list[list[dict]]) -> str:
+        names = {"user": "用户", "assistant": "助手"}
+        return "\n".join(
+            f"{names.get(msg['role'], msg['role'])}: {msg['content']}"
+            for turn in turns
+            for msg in turn
+        )
+
+    def _turn_keys(self, turns: list[list[dict]]) -> list[str]:
+        """Cache key of every turn.
+
+        Turns of the conversation store are keyed by their message ids, which
+        stay the same whichever window of the conversation is passed in.
+        Without ids a turn is keyed by its messages and those of the turn
+        before it, which keeps identical turns of different conversations
+        apart but changes once the turn is the first one of the window.
+        """
+        digests = []
+        for turn in turns:
+            hasher = hashlib.sha1()
+            for msg in turn:
+                hasher.update(f"\x00{msg['role']}\x00{msg['content']}".encode())
+            digests.append(hasher.hexdigest())
+
+        keys = []
+        for i, turn in enumerate(turns):
+            if all(msg.get("id") is not None for msg in turn):
+                identity = "id:" + ",".join(str(msg["id"]) for msg in turn)
+            else:
+                identity = f"content:{digests[i - 1] if i > 0 else ''}:{digests[i]}"
+            keys.append(hashlib.sha1(f"{self.summary_budget}\x00{identity}".encode()).hexdigest())
+        return keys
+
+    def summarize(self, turns: list[list[dict]]) -> str:
+        """Summarize the turns, extending the cached summary of the latest of them that has one."""
+        if not turns:
+            return ""
+        keys = self._turn_keys(turns)
+
+        previous, start = "", 0
+        with self._cache_lock:
+            for i in range(len(keys) - 1, -1, -1):
+                if keys[i] in self._summary_cache:
+                    self._summary_cache.move_to_end(keys[i])
+                    previous, start = self._summary_cache[keys[i]], i + 1
+                    break
+        if start == len(turns):
+            return previous
+
+        if self.__summary_agent is None:
+            self.__summary_agent = Agent(prompt=SUMMARY_PROMPT, llm_model=self.llm_model)
+        try:
+            summary = self.__summary_agent.invoke(
+                self._format_turns(turns[start:]),
+                previous_summary=previous or "无",
+                max_words=self.summary_budget,
+            )
+        except Exception as e:
+            self.logger.error(f"history summary error: {e}")
+            return previous
+
+        with self._cache_lock:
+            self._summary_cache[keys[-1]] = summary
+            while len(self._summary_cache) > self.cache_size:
+                self._summary_cache.popitem(last=False)
+        return summary
+
+    def compact(self, history: list[dict]) -> list[dict]:
+        """Compact the chat history so that it fits into the token budget.
+
+        Args:
+            history: Chat history as a list of {"role", "content"} dicts.
+
+        Returns:
+            The recent turns verbatim, preceded by a summary of the older turns if any.
+        """
+        turns = split_turns(history)
+        costs = [self._turn_tokens(turn) for turn in turns]
+        if sum(costs) <= self.token_budget:
+            return list(history)
+
+        recent_budget = self.token_budget - self.summary_budget
+        keep, used = 0, 0
+        for cost in reversed(costs):
+            if keep >= self.min_recent_turns and used + cost > recent_budget:
+                break
+            keep += 1
+            used += cost
+
+        older, recent = turns[: len(turns) - keep], turns[len(turns) - keep:]
+        if used > recent_budget:
+            share = recent_budget // max(len(recent), 1)
+            recent = [self._truncate(turn, share) for turn in recent]
+
+        compacted = []
+        summary = self.summarize(older)
+        if summary:
+            compacted.append({"role": "assistant", "content": SUMMARY_PREFIX + summary})
+        for turn in recent:
+            compacted.extend(turn)
+        return compacted
+
+
+def recent_messages(history: list[dict], token_budget: int) -> list[dict]:
+    """The most recent messages that fit into the token budget, the last one is cut to fit if needed."""
+    kept, used = [], 0
+    for msg in reversed(history):
+        cost = count_tokens(msg["content"])
+        if used + cost > token_budget:
+            if not kept:
+                kept = HistoryManager._truncate([msg], token_budget)
+            break
+        kept.append(msg)
+        used += cost
+    return kept[::-1]
@@ -1,22 +1,29 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
 import os
+import uuid
 import dotenv
 
 from typing import Iterator, Union
 from rag.search import doc_rag_stream
+from utils.connect_oceanbse import connect_oceanbase
+from utils.conversation_store import get_conversation_store
 
 import streamlit as st
 
 dotenv.load_dotenv()
 
+# Build the vector store and prewarm its connection pool before the first question.
+if os.getenv("VECTOR_BACKEND", "oceanbase") == "oceanbase":
+    connect_oceanbase()
+
 
 class StreamResponse:
     def __init__(self, chunks=None):
         if chunks is None:
             chunks = []
         self.chunks = chunks
-        self.__whole_msg = ""
+        self.__parts: list[str] = []
 
     def generate(
             self,
@@ -27,13 +34,13 @@ class StreamResponse:
         if prefix:
             yield prefix
         for chunk in self.chunks:
-            self.__whole_msg += chunk.content
+            self.__parts.append(chunk.content)
             yield chunk.content
         if suffix:
             yield suffix
 
     def get_whole(self) -> str:
-        return self.__whole_msg
+        return "".join(self.__parts)
 
 
 lang = os.getenv("UI_LANG", "zh")
@@ -82,15 +89,27 @@ oceanbase_only = True
 show_refs = True
 rerank = False
 
-if "messages" not in st.session_state:
-    st.session_state["messages"] = [{"role": "assistant", "content": "您好，请问有什么可以帮助您的吗？"}]
+# Messages live in the conversation store, the session id in the url lets a reload resume the conversation.
+store = get_conversation_store()
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = st.query_params.get("sid") or uuid.uuid4().hex
+    st.query_params["sid"] = st.session_state["session_id"]
+session_id = st.session_state["session_id"]
+page_size = int(os.getenv("CONVERSATION_PAGE_SIZE", 20))
 
 avatar_m = {
     "assistant": "🤖",
     "user": "🧑",
 }
 
-for msg in st.session_state.messages:
+shown = st.session_state.setdefault("history_pages", 1) * page_size
+if store.count(session_id) > shown and st.button("加载更早的消息"):
+    st.session_state["history_pages"] += 1
+    shown += page_size
+
+if store.count(session_id) <= shown:
+    st.chat_message("assistant", avatar=avatar_m["assistant"]).write("您好，请问有什么可以帮助您的吗？")
+for msg in store.recent(session_id, shown):
     st.chat_message(msg["role"], avatar=avatar_m[msg["role"]]).write(msg["content"])
 
 
@@ -101,7 +120,7 @@ def remove_refs(history: list[dict]) -> list[dict]:
     """
     return [
         {
-            "role": msg["role"],
+            **msg,
             "content": msg["content"].split("根据向量相似性匹配检索到的相关文档如下:")[0],
         }
         for msg in history
@@ -112,7 +131,7 @@ response_placeholder = st.empty()
 if prompt := st.chat_input("请输入您的问题..."):
     st.chat_message("user", avatar=avatar_m["user"]).write(prompt)
 
-    history = st.session_state["messages"][-history_len:] if history_len > 0 else []
+    history = store.recent_turns(session_id, history_len)
 
     it = doc_rag_stream(
         query=prompt,
@@ -129,10 +148,10 @@ if prompt := st.chat_input("请输入您的问题..."):
 
     res = StreamResponse(it)
 
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    store.append(session_id, "user", prompt)
 
     st.chat_message("assistant", avatar=avatar_m["assistant"]).write_stream(
         res.generate()
     )
 
-    st.session_state.messages.append({"role": "assistant", "content": res.get_whole()})
+    store.append(session_id, "assistant", res.get_whole())
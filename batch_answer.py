@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import contextvars
+import dotenv
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from rag.embeddings import get_embedding
+from rag.classifier import get_classifier
+from rag.documents import Citation, section_map
+from rag.search import doc_search_by_vector, format_snippets, link_citations
+from agent.prompt import RAG_PROMPT, SECTION_PROMPT, INTENT_PROMPT
+from agent.base_agent import Agent
+from utils.rate_limit import Priority, request_priority
+
+dotenv.load_dotenv()
+
+
+def load_questions(path: str) -> list[dict]:
+    """Questions of a JSONL file of {"question", "id"?}, a missing id is derived from the question."""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            item.setdefault("id", hashlib.md5(item["question"].encode("utf-8")).hexdigest())
+            questions.append(item)
+    return questions
+
+
+def load_done(path: str) -> set:
+    """Ids already answered without error in an earlier run."""
+    done = set()
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of an interrupted run may be cut off.
+                    continue
+                if not record.get("error"):
+                    done.add(record["id"])
+    return done
+
+
+class BatchAnswerer:
+    """
+    Offline question answering over a list of questions.
+
+    Queries are embedded in large batches, retrieval runs section by section
+    and the LLM calls of classification and generation share one pool of
+    `concurrency` workers. Every call runs at batch priority, so interactive
+    traffic sharing the rate limits goes first.
+    """
+
+    def __init__(self, llm_model: str, concurrency: int = 8, embed_batch_size: int = 64, universal_rag: bool = False):
+        self.concurrency = concurrency
+        self.embed_batch_size = embed_batch_size
+        self.universal_rag = universal_rag
+        self.embedding = get_embedding()
+        self.classifier = get_classifier()
+        self.intent_agent = Agent(prompt=INTENT_PROMPT, llm_model=llm_model)
+        self.section_agent = Agent(prompt=SECTION_PROMPT, llm_model=llm_model)
+        self.rag_agent = Agent(prompt=RAG_PROMPT, llm_model=llm_model)
+
+    def _submit(self, executor: ThreadPoolExecutor, fn, *args):
+        # Worker threads do not inherit context variables such as the request priority.
+        return executor.submit(contextvars.copy_context().run, fn, *args)
+
+    def embed(self, items: list[dict]):
+        for start in range(0, len(items), self.embed_batch_size):
+            batch = items[start: start + self.embed_batch_size]
+            batch_start = time.perf_counter()
+            vectors = self.embedding.embed_documents([item["question"] for item in batch])
+            elapsed = (time.perf_counter() - batch_start) / len(batch)
+            for item, vector in zip(batch, vectors):
+                item["vector"] = vector
+                item["timings"]["embed_s"] = elapsed
+
+    def classify(self, item: dict):
+        start = time.perf_counter()
+        min_confidence = getattr(self.classifier, "min_confidence", 1)
+        prediction = self.classifier.predict(item["vector"]) if self.classifier is not None else {}
+
+        if prediction.get("intent_confidence", 0) >= min_confidence:
+            item["type"] = prediction["type"]
+        else:
+            intent = self.intent_agent.invoke_json(item["question"], keys=["type"])
+            item["type"] = intent.get("type", "Algorithm")
+
+        if item["type"] == "Chat":
+            item["sections"] = []
+        elif prediction.get("section_confidence", 0) >= min_confidence:
+            item["sections"] = [sec for sec in prediction["components"] if sec in section_map]
+        else:
+            section = self.section_agent.invoke_json(item["question"], keys=["components"])
+            sections = section.get("components", ["Basic"])
+            item["sections"] = list(set(sec for sec in sections if sec in section_map))
+        item["timings"]["classify_s"] = time.perf_counter() - start
+
+    def retrieve(self, items: list[dict]):
+        """Search section by section, so consecutive searches hit the same partition."""
+        by_section = defaultdict(list)
+        for item in items:
+            item["docs"] = []
+            item["timings"]["retrieve_s"] = 0.0
+            if self.universal_rag:
+                by_section[None].append(item)
+            for sec in item.get("sections", []):
+                by_section[sec].append(item)
+
+        for sec, group in by_section.items():
+            for item in group:
+                start = time.perf_counter()
+                try:
+                    item["docs"].extend(doc_search_by_vector(item["vector"], [sec] if sec else None))
+                except Exception as e:
+                    item["error"] = f"retrieve: {e}"
+                item["timings"]["retrieve_s"] += time.perf_counter() - start
+
+        for item in items:
+            item["docs"] = item["docs"][:10]
+
+    def generate(self, item: dict) -> dict:
+        start = time.perf_counter()
+        docs = item["docs"]
+        answer = self.rag_agent.invoke(item["question"], [], document_snippets=format_snippets(docs))
+        citations = [Citation.from_metadata(doc.metadata) for doc in docs]
+        visited, references = {}, []
+        answer = link_citations(answer, citations, visited, references)
+        item["timings"]["generate_s"] = time.perf_counter() - start
+        return {
+            "answer": answer,
+            "references": references,
+            "retrieved": [{"title": c.title, "url": c.url} for c in citations],
+        }
+
+    def run(self, questions: list[dict], output: str, chunk_size: int = 256):
+        """Answer the questions, appending one JSON line per question to the output as soon as it is done."""
+        done = load_done(output)
+        pending = [dict(q, timings={}) for q in questions if q["id"] not in done]
+        print(f"{len(questions)} questions, {len(questions) - len(pending)} already answered, {len(pending)} to go")
+
+        write_lock = threading.Lock()
+        answered, failed = 0, 0
+        with request_priority(Priority.BATCH), \
+                open(output, "a", encoding="utf-8") as out, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            def write(item: dict, result: dict = None, error: str = None):
+                record = {
+                    "id": item["id"],
+                    "question": item["question"],
+                    "type": item.get("type"),
+                    "sections": item.get("sections"),
+                    **(result or {}),
+                    "timings": item["timings"],
+                    "error": error,
+                }
+                with write_lock:
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+
+            # Chunks bound the memory of vectors and documents, and the work lost on interruption.
+            for chunk_start in range(0, len(pending), chunk_size):
+                chunk = pending[chunk_start: chunk_start + chunk_size]
+                self.embed(chunk)
+
+                classified = []
+                if self.universal_rag:
+                    for item in chunk:
+                        item.update(type="Algorithm", sections=[])
+                    classified = chunk
+                else:
+                    futures = {self._submit(executor, self.classify, item): item for item in chunk}
+                    for future in as_completed(futures):
+                        if future.exception() is not None:
+                            write(futures[future], error=f"classify: {future.exception()}")
+                            failed += 1
+                        else:
+                            classified.append(futures[future])
+
+                self.retrieve(classified)
+                for item in classified:
+                    if "error" in item:
+                        write(item, error=item["error"])
+                        failed += 1
+
+                futures = {
+                    self._submit(executor, self.generate, item): item for item in classified if "error" not in item
+                }
+                for future in as_completed(futures):
+                    if future.exception() is not None:
+                        write(futures[future], error=f"generate: {future.exception()}")
+                        failed += 1
+                    else:
+                        write(futures[future], future.result())
+                        answered += 1
+                print(f"{chunk_start + len(chunk)}/{len(pending)} processed, {answered} answered, {failed} failed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions offline, resumable.")
+    parser.add_argument("input", help="JSONL file of {\"question\", \"id\"?}")
+    parser.add_argument("output", help="JSONL file of answers, questions answered in it are skipped")
+    parser.add_argument("--llm-model", default=os.getenv("LLM_MODEL", "qwen-plus"))
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BATCH_CONCURRENCY", 8)))
+    parser.add_argument("--embed-batch-size", type=int, default=64)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--universal-rag", action="store_true", help="skip intent and section analysis")
+    args = parser.parse_args()
+
+    BatchAnswerer(args.llm_model, args.concurrency, args.embed_batch_size, args.universal_rag).run(
+        load_questions(args.input), args.output, args.chunk_size
+    )
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import argparse
+import dotenv
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from rag.local_index import FlatIndex, IVFIndex, TwoStageIndex, exact_topk
+
+dotenv.load_dotenv()
+
+LOCAL_CONFIGS = [
+    {"index_type": "FLAT"},
+    {"index_type": "IVF", "index_params": {"nlist": 64}, "search_params": [{"nprobe": n} for n in (1, 4, 16)]},
+    {"index_type": "IVF", "index_params": {"nlist": 256}, "search_params": [{"nprobe": n} for n in (1, 4, 16, 64)]},
+    {"index_type": "TWO_STAGE", "index_params": {"dim": 128}, "search_params": [{"shortlist": n} for n in (20, 50, 100)]},
+    {"index_type": "TWO_STAGE", "index_params": {"dim": 256}, "search_params": [{"shortlist": n} for n in (20, 50, 100)]},
+]
+
+OCEANBASE_CONFIGS = [
+    {
+        "index_type": "HNSW",
+        "index_params": {"M": 16, "efConstruction": 200},
+        "search_params": [{"efSearch": ef} for ef in (16, 32, 64, 128, 256)],
+    },
+    {
+        "index_type": "HNSW",
+        "index_params": {"M": 32, "efConstruction": 400},
+        "search_params": [{"efSearch": ef} for ef in (16, 32, 64, 128, 256)],
+    },
+]
+
+
+class PrecomputedEmbedding(Embeddings):
+    """Embedding function of the scratch table: the text of each row is its index into the vectors."""
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.vectors[int(text)].tolist() for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def load_vectors(limit: int, seed: int) -> np.ndarray:
+    from utils.connect_oceanbse import iter_corpus
+
+    vectors = np.asarray([row["embedding"] for row in iter_corpus()], dtype=np.float32)
+    if 0 < limit < len(vectors):
+        vectors = vectors[np.random.default_rng(seed).choice(len(vectors), size=limit, replace=False)]
+    return vectors
+
+
+def load_questions(path: str) -> np.ndarray:
+    from rag.embeddings import get_embedding
+
+    with open(path, "r", encoding="utf-8") as f:
+        questions = [json.loads(line)["question"] for line in f if line.strip()]
+    embedding = get_embedding()
+    vectors = []
+    for i in range(0, len(questions), 16):
+        vectors.extend(embedding.embed_documents(questions[i: i + 16]))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def build_local(base: np.ndarray, config: dict, metric: str):
+    """Build a local index, returns its search function and the size of the vectors scanned per query."""
+    if config["index_type"] == "FLAT":
+        index = FlatIndex(base, metric)
+        return lambda query, k, params: index.search(query, k), index.vectors.nbytes
+    if config["index_type"] == "IVF":
+        index = IVFIndex(base, metric=metric, **config.get("index_params", {}))
+
+        def search(query, k, params):
+            index.nprobe = params.get("nprobe", index.nprobe)
+            return index.search(query, k)
+        return search, index.flat.vectors.nbytes
+    if config["index_type"] == "TWO_STAGE":
+        index = TwoStageIndex(base, metric=metric, **config.get("index_params", {}))
+
+        def search(query, k, params):
+            index.shortlist = params.get("shortlist", index.shortlist)
+            return index.search(query, k)
+        return search, index.coarse.vectors.nbytes
+    raise ValueError(f"index type {config['index_type']} not supported by the local backend.")
+
+
+def build_oceanbase(base: np.ndarray, config: dict, metric: str, table_name: str):
+    from langchain_oceanbase.vectorstores import OceanbaseVectorStore
+    from utils.connect_oceanbse import apply_search_params, connection_args, vector_index_args
+    from utils.db_pool import pool_args
+
+    if config["index_type"] != "HNSW":
+        # The pinned langchain-oceanbase has no index type argument and always builds HNSW.
+        raise ValueError(f"index type {config['index_type']} not supported by the oceanbase backend, only HNSW.")
+    store = OceanbaseVectorStore(
+        embedding_function=PrecomputedEmbedding(base),
+        table_name=table_name,
+        connection_args=connection_args,
+        drop_old=True,
+        **vector_index_args(config.get("index_params"), metric),
+        **pool_args(),
+    )
+    for i in range(0, len(base), 500):
+        store.add_texts([str(j) for j in range(i, min(i + 500, len(base)))])
+
+    def search(query, k, params):
+        apply_search_params(store, params)
+        docs = store.similarity_search_by_vector(query.tolist(), k=k, param=params or None)
+        return [int(doc.page_content) for doc in docs]
+    return search, store
+
+
+def measure(search, queries: np.ndarray, truth: np.ndarray, k: int, params: dict) -> dict:
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = search(query, k, params)
+        latencies.append(time.perf_counter() - start)
+        hits += len(set(int(i) for i in found[:k]) & set(int(i) for i in expected))
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "recall": hits / truth.size,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "qps": len(queries) / (latencies.sum() / 1000),
+    }
+
+
+def mark_pareto(results: list[dict]):
+    """A configuration is Pareto-optimal if no other one has both higher recall and lower p50 latency."""
+    for r in results:
+        r["pareto"] = not any(
+            o["recall"] >= r["recall"] and o["p50_ms"] <= r["p50_ms"]
+            and (o["recall"] > r["recall"] or o["p50_ms"] < r["p50_ms"])
+            for o in results
+        )
+
+
+def print_table(results: list[dict], k: int):
+    header = f"{'':2}{'index':<10}{'build params':<32}{'search params':<24}{'build s':>9}{'index MB':>10}" \
+             f"{f'recall@{k}':>11}{'p50 ms':>9}{'p95 ms':>9}{'qps':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in sorted(results, key=lambda x: (-x["recall"], x["p50_ms"])):
+        index_mb = f"{r['index_bytes'] / 2 ** 20:.1f}" if r["index_bytes"] is not None else "-"
+        print(
+            f"{'*' if r['pareto'] else '':2}{r['index_type']:<10}"
+            f"{json.dumps(r['index_params']):<32}{json.dumps(r['search_params']):<24}"
+            f"{r['build_s']:>9.2f}{index_mb:>10}{r['recall']:>11.4f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['qps']:>9.1f}"
+        )
+    print("* Pareto-optimal: no other configuration is both more accurate and faster.")
+
+
+def sweep(args):
+    vectors = load_vectors(args.limit, args.seed)
+    if args.questions:
+        base, queries = vectors, load_questions(args.questions)
+    else:
+        order = np.random.default_rng(args.seed).permutation(len(vectors))
+        queries, base = vectors[order[: args.queries]], vectors[order[args.queries:]]
+    print(f"{len(base)} base vectors, {len(queries)} queries, dimension {base.shape[1]}")
+
+    start = time.perf_counter()
+    truth = exact_topk(base, queries, args.k, args.metric)
+    print(f"Exact ground truth computed in {time.perf_counter() - start:.2f}s")
+
+    if args.configs:
+        with open(args.configs, "r", encoding="utf-8") as f:
+            configs = json.load(f)
+    else:
+        configs = LOCAL_CONFIGS if args.backend == "local" else OCEANBASE_CONFIGS
+
+    results = []
+    for config in configs:
+        start = time.perf_counter()
+        store, index_bytes = None, None
+        if args.backend == "local":
+            search, index_bytes = build_local(base, config, args.metric)
+        else:
+            search, store = build_oceanbase(base, config, args.metric, args.table_name)
+        build_s = time.perf_counter() - start
+
+        try:
+            for params in config.get("search_params") or [{}]:
+                result = measure(search, queries, truth, args.k, params)
+                result.update({
+                    "index_type": config["index_type"],
+                    "index_params": config.get("index_params", {}),
+                    "search_params": params,
+                    "build_s": build_s,
+                    "index_bytes": index_bytes,
+                })
+                print(f"{config['index_type']} {result['index_params']} {params}: recall {result['recall']:.4f}")
+                results.append(result)
+        finally:
+            if store is not None:
+                store.obvector.drop_table_if_exist(args.table_name)
+
+    mark_pareto(results)
+    print_table(results, args.k)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep vector index parameters against exact ground truth.")
+    parser.add_argument("--backend", choices=["local", "oceanbase"], default="local")
+    parser.add_argument("--configs", help="JSON list of {index_type, index_params, search_params: [..]}")
+    parser.add_argument("--questions", help="JSONL file of {\"question\": ...} used as queries")
+    parser.add_argument("--queries", type=int, default=200, help="corpus vectors held out as queries")
+    parser.add_argument("--limit", type=int, default=0, help="sample at most this many corpus vectors")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--metric", default=os.getenv("OB_VECTOR_METRIC", "l2"))
+    parser.add_argument("--table-name", default=os.getenv("TABLE_NAME", "corpus") + "_sweep")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    sweep(parser.parse_args())
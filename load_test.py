@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import dotenv
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from langchain_core.messages import AIMessageChunk
+
+dotenv.load_dotenv()
+
+DEFAULT_QUESTIONS = [
+    "动态规划的一些常见使用",
+    "如何在有向图中求解从源节点到所有其他节点的最短路径？",
+    "逆元怎么计算？",
+    "快速排序的时间复杂度是多少",
+    "KMP 算法的 next 数组如何构造",
+    "线段树如何支持区间修改和区间查询",
+    "最小生成树有哪些算法",
+    "二分答案适用于什么样的问题",
+]
+
+
+def load_questions(path: str) -> list[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["question"] for line in f if line.strip()]
+
+
+def write_synthetic_snapshot(path: str, docs_per_section: int, dimension: int, seed: int):
+    """Random unit vectors with placeholder documents in every section, for load tests without a corpus."""
+    from rag.documents import section_map
+    from rag.snapshot import SnapshotWriter
+
+    rng = np.random.default_rng(seed)
+    with SnapshotWriter(path, table_name="synthetic") as writer:
+        for section, code in section_map.items():
+            vectors = rng.standard_normal((docs_per_section, dimension)).astype(np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            for i, vector in enumerate(vectors):
+                title = f"{section} 测试文档 {i}"
+                writer.write(
+                    f"{section}-{i}",
+                    f"# {title}\n\n" + "这是一个用于压力测试的文档片段。" * 20,
+                    {
+                        "doc_url": f"https://oi-wiki.org/{section.lower()}/test-{i}/",
+                        "doc_name": title,
+                        "chunk_title": title,
+                        "enhanced_title": title,
+                    },
+                    code,
+                    vector,
+                )
+
+
+def setup_stand_ins(args) -> list:
+    """Point the LLM, the embedding and the vector store at local stand-ins, returns objects to clean up."""
+    resources = []
+    if args.llm == "fake" or args.embedding == "fake":
+        from utils.fake_openai import FakeOpenAIServer
+
+        fake = FakeOpenAIServer(first_token_delay=args.first_token_delay, token_delay=args.token_delay).start()
+        resources.append(fake)
+        print(f"Fake OpenAI-compatible server listening on {fake.url}")
+        if args.llm == "fake":
+            os.environ.update({"LLM_BASE_URL": fake.url, "API_KEY": "fake", "LLM_MODEL": "fake"})
+            os.environ.pop("LLM_FALLBACK_MODEL", None)
+        if args.embedding == "fake":
+            from rag.embeddings import get_embedding
+
+            get_embedding(base_url=f"{fake.url}/embeddings", api_key="fake", model="fake", dimensions=args.dimension)
+
+    if args.store == "synthetic":
+        snapshot_dir = tempfile.TemporaryDirectory()
+        resources.append(snapshot_dir)
+        write_synthetic_snapshot(snapshot_dir.name, args.synthetic_docs, args.dimension, args.seed)
+        os.environ.update({"VECTOR_BACKEND": "local", "SNAPSHOT_PATH": snapshot_dir.name})
+    elif args.store == "local":
+        os.environ["VECTOR_BACKEND"] = "local"
+    else:
+        os.environ["VECTOR_BACKEND"] = "oceanbase"
+
+    if args.no_cache:
+        os.environ["RETRIEVAL_CACHE_SIZE"] = "0"
+    # Coalescing identical questions would measure deduplicated traffic instead of distinct users.
+    os.environ["SINGLE_FLIGHT"] = "true" if args.single_flight else "false"
+    return resources
+
+
+def run_request(question: str, scheduled: float, universal_rag: bool) -> dict:
+    """Answer one question, times are measured from the scheduled arrival so queueing is included."""
+    from rag.search import doc_rag_stream
+
+    result = {"ttft": None, "latency": None, "error": None}
+    try:
+        for chunk in doc_rag_stream(question, [], os.getenv("LLM_MODEL", "qwen-plus"), universal_rag=universal_rag):
+            if result["ttft"] is None and isinstance(chunk, AIMessageChunk) and chunk.content:
+                result["ttft"] = time.perf_counter() - scheduled
+        result["latency"] = time.perf_counter() - scheduled
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_stage(questions: list[str], rate: float, requests: int, concurrency: int, universal_rag: bool, seed: int) -> dict:
+    """Open-loop stage: Poisson arrivals at `rate` per second, at most `concurrency` requests in flight."""
+    rng = random.Random(seed)
+    in_flight, max_in_flight = 0, 0
+    lock = threading.Lock()
+
+    def task(question, scheduled):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        try:
+            return run_request(question, scheduled, universal_rag)
+        finally:
+            with lock:
+                in_flight -= 1
+
+    futures = []
+    start = time.perf_counter()
+    scheduled = start
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(requests):
+            scheduled += rng.expovariate(rate)
+            time.sleep(max(0.0, scheduled - time.perf_counter()))
+            futures.append(executor.submit(task, questions[i % len(questions)], scheduled))
+        arrival_s = scheduled - start
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r["error"] is None]
+    ttft = np.asarray([r["ttft"] for r in ok if r["ttft"] is not None]) * 1000
+    latency = np.asarray([r["latency"] for r in ok]) * 1000
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+    def percentile(values, q):
+        return float(np.percentile(values, q)) if len(values) else float("nan")
+
+    return {
+        "rate": rate,
+        "requests": requests,
+        "offered": requests / arrival_s if arrival_s > 0 else float("inf"),
+        "throughput": len(ok) / elapsed,
+        "arrival_s": arrival_s,
+        "error_rate": 1 - len(ok) / requests,
+        "max_in_flight": max_in_flight,
+        **{f"ttft_p{q}_ms": percentile(ttft, q) for q in (50, 95, 99)},
+        **{f"latency_p{q}_ms": percentile(latency, q) for q in (50, 95, 99)},
+        "errors": errors,
+    }
+
+
+def mark_saturation(results: list[dict], slo_ms: float, max_error_rate: float):
+    """A stage is saturated once completions fall behind arrivals, the p95 latency misses the SLO or errors pile up.
+
+    Without queueing the last request finishes about one median latency after
+    the last arrival, so completions falling behind shows up as throughput
+    below 90% of requests / (arrival time + p50 latency).
+    """
+    for r in results:
+        expected = r["requests"] / (r["arrival_s"] + r["latency_p50_ms"] / 1000)
+        r["saturated"] = (
+            not r["throughput"] >= 0.9 * expected
+            or r["error_rate"] > max_error_rate
+            or not r["latency_p95_ms"] <= slo_ms
+        )
+
+
+def print_report(results: list[dict], concurrency: int, slo_ms: float):
+    header = f"{'':2}{'rate/s':>8}{'req/s':>8}{'errors':>8}{'in flight':>11}" \
+             f"{'ttft p50':>10}{'ttft p95':>10}{'ttft p99':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{'!' if r['saturated'] else '':2}{r['rate']:>8.2f}{r['throughput']:>8.2f}{r['error_rate']:>8.1%}"
+            f"{r['max_in_flight']:>11}{r['ttft_p50_ms']:>10.0f}{r['ttft_p95_ms']:>10.0f}{r['ttft_p99_ms']:>10.0f}"
+            f"{r['latency_p50_ms']:>10.0f}{r['latency_p95_ms']:>10.0f}{r['latency_p99_ms']:>10.0f}"
+        )
+        for error, count in r["errors"].items():
+            print(f"{'':10}{count} x {error}")
+    print(f"! saturated: completions fall behind arrivals, p95 latency above {slo_ms:.0f} ms or too many errors.")
+
+    sustainable = [r for r in results if not r["saturated"]]
+    saturated = [r for r in results if r["saturated"]]
+    if sustainable:
+        best = max(sustainable, key=lambda r: r["rate"])
+        print(f"Highest sustainable rate: {best['rate']:.2f} req/s with {concurrency} concurrent requests.")
+    if saturated:
+        print(f"Saturation point: {min(r['rate'] for r in saturated):.2f} req/s.")
+    else:
+        print("No saturation within the tested rates.")
+
+
+def load_test(args):
+    resources = setup_stand_ins(args)
+    try:
+        questions = load_questions(args.questions) if args.questions else DEFAULT_QUESTIONS
+        print(f"{len(questions)} questions, llm {args.llm}, embedding {args.embedding}, store {args.store}")
+
+        if args.warmup:
+            warmup = run_request(questions[0], time.perf_counter(), args.universal_rag)
+            if warmup["error"] is not None:
+                # A misconfigured setup would otherwise only show up as 100% errors in every stage.
+                raise RuntimeError(f"Warm-up request failed: {warmup['error']}")
+
+        results = []
+        for stage, rate in enumerate(float(r) for r in args.rates.split(",")):
+            requests = args.requests or max(1, int(rate * args.duration))
+            result = run_stage(questions, rate, requests, args.concurrency, args.universal_rag, args.seed + stage)
+            print(
+                f"rate {rate:.2f}/s: {result['throughput']:.2f} req/s, "
+                f"p95 {result['latency_p95_ms']:.0f} ms, errors {result['error_rate']:.1%}"
+            )
+            results.append(result)
+
+        mark_saturation(results, args.slo_ms, args.max_error_rate)
+        print_report(results, args.concurrency, args.slo_ms)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+    finally:
+        for resource in resources:
+            if hasattr(resource, "stop"):
+                resource.stop()
+            else:
+                resource.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay questions against doc_rag_stream at increasing arrival rates.")
+    parser.add_argument("--questions", help="JSONL file of {\"question\": ...}, defaults to built-in questions")
+    parser.add_argument("--rates", default="0.5,1,2,4,8", help="comma separated arrival rates in requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of arrivals per rate")
+    parser.add_argument("--requests", type=int, default=0, help="fixed number of requests per rate instead of --duration")
+    parser.add_argument("--concurrency", type=int, default=16, help="maximum requests in flight")
+    parser.add_argument("--universal-rag", action="store_true", help="skip intent and section analysis")
+    parser.add_argument("--llm", choices=["fake", "real"], default="fake")
+    parser.add_argument("--embedding", choices=["fake", "real"], default="fake")
+    parser.add_argument("--store", choices=["synthetic", "local", "oceanbase"], default="synthetic")
+    parser.add_argument("--first-token-delay", type=float, default=0.5, help="fake LLM delay before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="fake LLM delay between tokens")
+    parser.add_argument("--synthetic-docs", type=int, default=200, help="synthetic documents per section")
+    parser.add_argument("--dimension", type=int, default=1024, help="dimension of the synthetic vectors and the fake embedding")
+    parser.add_argument("--no-cache", action="store_true", help="disable the retrieval cache")
+    parser.add_argument("--single-flight", action="store_true", help="coalesce identical in-flight questions")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false")
+    parser.add_argument("--slo-ms", type=float, default=10000, help="p95 latency objective")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    load_test(parser.parse_args())
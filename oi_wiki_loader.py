@@ -5,9 +5,12 @@ import uuid
 import dotenv
 
 from langchain_core.documents import Document
-from rag.embeddings import get_embedding
+from rag.embeddings import BGEEmbedding, get_embedding
+from rag.cache import get_retrieval_cache
+from rag.dedup import NearDuplicateFilter
 from rag.documents import MarkdownDocumentsLoader, section_map
 from utils.connect_oceanbse import connect_oceanbase
+from utils.rate_limit import Priority, request_priority
 
 dotenv.load_dotenv()
 
@@ -56,15 +59,35 @@ def insert_batch(docs: list[Document], section):
         extras=[{"section_code": code} for _ in docs],
         partition_name=section,
     )
+    get_retrieval_cache().invalidate(section)
+    if isinstance(embeddings, BGEEmbedding):
+        # Precompute the passage representations used by rerank.
+        embeddings.store_passages([doc.page_content for doc in docs])
 
 
-def insert_oi_wiki(file_dir: str, partition_name):
+def print_dedup_report(name: str, report: dict):
+    print(
+        f"{name}: {report['input_chunks']} chunks, {report['removed_chunks']} near duplicates removed "
+        f"({report['removed_ratio']:.1%}, {report['removed_chars']} characters), {report['kept_chunks']} to insert."
+    )
+
+
+def insert_oi_wiki(file_dir: str, partition_name, dedup_filter: NearDuplicateFilter = None):
+    """Insert the documents of a directory into a partition.
+
+    Near duplicates are only removed within the partition, as retrieval searches the sections separately.
+    Pass the same dedup_filter to the calls of every section to report the total shrinkage.
+    """
     batch_size = 4
     limit = 300
 
     batch = []
     loader = MarkdownDocumentsLoader(file_dir)
-    for doc in loader.load(limit=limit):
+    if dedup_filter is None:
+        dedup_filter = NearDuplicateFilter()
+    docs, report = dedup_filter.dedup(list(loader.load(limit=limit)))
+    print_dedup_report(partition_name, report)
+    for doc in docs:
         if len(batch) == batch_size:
             insert_batch(batch, partition_name)
             batch = []
@@ -75,18 +98,21 @@ def insert_oi_wiki(file_dir: str, partition_name):
 
 
 if __name__ == '__main__':
-    optimize_ob_args()
-    # insert_oi_wiki("doc\\docs\\basic", "Basic")
-    # insert_oi_wiki("doc\\docs\\dp", "DP")
-    # insert_oi_wiki("doc\\docs\\ds", "DS")
-    # insert_oi_wiki("doc\\docs\\geometry", "Geometry")
-    # insert_oi_wiki("doc\\docs\\graph", "Graph")
-    # insert_oi_wiki("doc\\docs\\math", "Math")
-    # insert_oi_wiki("doc\\docs\\misc", "Misc")
-    # insert_oi_wiki("doc\\docs\\search", "Search")
-    # insert_oi_wiki("doc\\docs\\string", "String")
-    # insert_oi_wiki("doc\\docs\\topic", "Topic")
-    # insert_oi_wiki("doc\\docs\\contest", "Contest")
-    # insert_oi_wiki("doc\\docs\\lang", "Lang")
-    # insert_oi_wiki("doc\\docs\\tools", "Tools")
-    ...
+    # Ingestion queues behind interactive questions in the shared rate limiters.
+    with request_priority(Priority.BATCH):
+        optimize_ob_args()
+        dedup_filter = NearDuplicateFilter(threshold=0.85)
+        # insert_oi_wiki("doc\\docs\\basic", "Basic", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\dp", "DP", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\ds", "DS", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\geometry", "Geometry", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\graph", "Graph", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\math", "Math", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\misc", "Misc", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\search", "Search", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\string", "String", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\topic", "Topic", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\contest", "Contest", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\lang", "Lang", dedup_filter)
+        # insert_oi_wiki("doc\\docs\\tools", "Tools", dedup_filter)
+        print_dedup_report("Total", dedup_filter.total())
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import time
+import argparse
+
+import numpy as np
+
+PARITY_TEXTS = [
+    "动态规划的一些常见使用",
+    "如何在有向图中求解从源节点到所有其他节点的最短路径？",
+    "逆元怎么计算？",
+    "快速排序的时间复杂度是多少",
+    "KMP 算法的 next 数组如何构造",
+    "线段树支持区间修改和区间查询",
+    "What is the difference between BFS and DFS?",
+    "C++ 中 std::vector 的 reserve 和 resize 有什么区别",
+]
+
+
+def export(output_dir: str, model_path: str = os.getenv("BGE_MODEL_PATH", "BAAI/bge-m3"), quantize: bool = True):
+    """Export BGE-M3 dense and sparse heads to ONNX, and a dynamically int8-quantized copy."""
+    import torch
+    from FlagEmbedding import BGEM3FlagModel
+
+    class Encoder(torch.nn.Module):
+        def __init__(self, model, sparse_linear):
+            super().__init__()
+            self.model = model
+            self.sparse_linear = sparse_linear
+
+        def forward(self, input_ids, attention_mask):
+            hidden = self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            dense = torch.nn.functional.normalize(hidden[:, 0], dim=-1)
+            sparse = torch.relu(self.sparse_linear(hidden)).squeeze(-1)
+            return dense, sparse
+
+    flag_model = BGEM3FlagModel(model_path, pooling_method="cls", normalize_embeddings=True, use_fp16=False)
+    encoder = Encoder(flag_model.model.model, flag_model.model.sparse_linear).float().eval().to("cpu")
+    tokenizer = flag_model.tokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    model_file = os.path.join(output_dir, "model.onnx")
+    dummy = tokenizer(["hello world", "你好"], padding=True, return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            (dummy["input_ids"], dummy["attention_mask"]),
+            model_file,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["dense_vecs", "sparse_weights"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "dense_vecs": {0: "batch"},
+                "sparse_weights": {0: "batch", 1: "sequence"},
+            },
+            opset_version=17,
+        )
+    tokenizer.save_pretrained(output_dir)
+    print(f"ONNX model saved to {model_file}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_file = os.path.join(output_dir, "model.int8.onnx")
+        # The fp32 graph of BGE-M3 exceeds the 2GB protobuf limit and is stored with external data.
+        quantize_dynamic(model_file, quantized_file, weight_type=QuantType.QInt8, use_external_data_format=True)
+        print(f"Quantized model saved to {quantized_file}")
+
+
+def _sparse_score(a: dict, b: dict) -> float:
+    return sum(weight * b[token] for token, weight in a.items() if token in b)
+
+
+def parity(model_dir: str, texts: list[str], min_cosine: float, max_sparse_error: float) -> bool:
+    """Compare the ONNX backend with the reference FlagEmbedding model.
+
+    Dense vectors must reach `min_cosine` cosine similarity, and the sparse
+    self-matching scores must agree within `max_sparse_error` relative error.
+    """
+    from rag.embeddings import BGEEmbedding, ONNXBGEEmbedding
+
+    reference = BGEEmbedding()
+    both = BGEEmbedding.EmbeddingType.Both
+    ref_dense, ref_sparse = reference.embed_documents(texts, embedding_type=both)
+
+    ok = True
+    for quantized in (False, True):
+        if not os.path.exists(os.path.join(model_dir, "model.int8.onnx" if quantized else "model.onnx")):
+            continue
+        candidate = ONNXBGEEmbedding(model_dir, quantized=quantized)
+        dense, sparse = candidate.embed_documents(texts, embedding_type=both)
+
+        cosines = np.sum(np.asarray(ref_dense) * np.asarray(dense), axis=1) / (
+            np.linalg.norm(ref_dense, axis=1) * np.linalg.norm(dense, axis=1)
+        )
+        sparse_errors = [
+            abs(_sparse_score(s, s) - _sparse_score(r, r)) / max(_sparse_score(r, r), 1e-12)
+            for r, s in zip(ref_sparse, sparse)
+        ]
+        passed = cosines.min() >= min_cosine and max(sparse_errors) <= max_sparse_error
+        ok = ok and passed
+        print(
+            f"{'int8' if quantized else 'fp32'}: dense cosine min {cosines.min():.5f} mean {cosines.mean():.5f}, "
+            f"sparse relative error max {max(sparse_errors):.4f} -> {'PASS' if passed else 'FAIL'}"
+        )
+    return ok
+
+
+def bench(model_dir: str, texts: list[str], rounds: int):
+    """Throughput of batched documents and latency of single queries for each backend."""
+    from rag.embeddings import BGEEmbedding, ONNXBGEEmbedding
+
+    backends = [("torch", BGEEmbedding)]
+    for quantized in (False, True):
+        if os.path.exists(os.path.join(model_dir, "model.int8.onnx" if quantized else "model.onnx")):
+            backends.append((
+                "onnx-int8" if quantized else "onnx-fp32",
+                lambda q=quantized: ONNXBGEEmbedding(model_dir, quantized=q),
+            ))
+
+    print(f"{'backend':<12}{'docs/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, factory in backends:
+        embedding = factory()
+        embedding.embed_documents(texts[:2])
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            embedding.embed_documents(texts)
+        throughput = rounds * len(texts) / (time.perf_counter() - start)
+
+        latencies = []
+        for _ in range(rounds):
+            for text in texts:
+                start = time.perf_counter()
+                embedding.embed_query(text)
+                latencies.append((time.perf_counter() - start) * 1000)
+        print(
+            f"{name:<12}{throughput:>10.1f}{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}"
+        )
+        del embedding
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export, check and benchmark the ONNX BGE-M3 backend.")
+    parser.add_argument("command", choices=["export", "parity", "bench"])
+    parser.add_argument("--model-dir", default=os.getenv("BGE_ONNX_PATH", "models/bge-m3-onnx"))
+    parser.add_argument("--no-quantize", action="store_true", help="export the fp32 graph only")
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    parser.add_argument("--max-sparse-error", type=float, default=0.05)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.model_dir, quantize=not args.no_quantize)
+    elif args.command == "parity":
+        exit(0 if parity(args.model_dir, PARITY_TEXTS, args.min_cosine, args.max_sparse_error) else 1)
+    else:
+        bench(args.model_dir, PARITY_TEXTS * 4, args.rounds)
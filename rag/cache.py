@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from langchain_core.documents import Document
+
+__retrieval_cache = None
+__retrieval_cache_lock = threading.Lock()
+
+# Signal file name of an invalidation of every partition.
+_ALL_PARTITIONS = "_all"
+
+
+def get_retrieval_cache():
+    global __retrieval_cache
+    with __retrieval_cache_lock:
+        if __retrieval_cache is None:
+            __retrieval_cache = RetrievalCache(
+                max_entries=int(os.getenv("RETRIEVAL_CACHE_SIZE", 1024)),
+                ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", 600)),
+                signal_dir=os.getenv("RETRIEVAL_CACHE_SIGNAL_DIR", "cache_signals"),
+            )
+        return __retrieval_cache
+
+
+class RetrievalCache:
+    """
+    Bounded LRU cache of vector search results with TTL.
+
+    Entries are keyed by a hash of the quantized query vector, the searched
+    partitions and k, so repeated and numerically identical queries skip the
+    database. Writing to a partition invalidates every entry that searched it.
+
+    Invalidations also reach the caches of other processes, e.g. the loader
+    invalidating the cache of the app: `invalidate` touches one signal file per
+    partition in `signal_dir`, and `get` drops the entries of every partition
+    whose file changed, checking at most once per `check_interval` seconds.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 1024,
+            ttl: float = 600,
+            precision: int = 4,
+            signal_dir: str = "",
+            check_interval: float = 1.0,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.scale = 10 ** precision
+        self.signal_dir = signal_dir
+        self.check_interval = check_interval
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__signals = self._read_signals()
+        self.__next_check = time.monotonic() + check_interval
+        self.__hits = 0
+        self.__misses = 0
+        self.__miss_latency = 0.0
+        self.__saved_latency = 0.0
+
+    def key(self, vector: list[float], partition_names: Optional[list[str]], k: int) -> tuple:
+        quantized = np.round(np.asarray(vector, dtype=np.float32) * self.scale).astype(np.int32)
+        digest = hashlib.blake2b(quantized.tobytes(), digest_size=16).hexdigest()
+        partitions = tuple(sorted(partition_names)) if partition_names else None
+        return digest, partitions, k
+
+    def _read_signals(self) -> dict[str, int]:
+        """Modification time of every signal file."""
+        if not self.signal_dir or not os.path.isdir(self.signal_dir):
+            return {}
+        with os.scandir(self.signal_dir) as it:
+            return {entry.name: entry.stat().st_mtime_ns for entry in it if entry.is_file()}
+
+    def __check_signals(self):
+        now = time.monotonic()
+        if not self.signal_dir or now < self.__next_check:
+            return
+        self.__next_check = now + self.check_interval
+        signals = self._read_signals()
+        for name, mtime in signals.items():
+            if self.__signals.get(name) != mtime:
+                self.__drop(None if name == _ALL_PARTITIONS else name)
+        self.__signals = signals
+
+    def __signal(self, partition_name: Optional[str]):
+        if not self.signal_dir:
+            return
+        os.makedirs(self.signal_dir, exist_ok=True)
+        file = os.path.join(self.signal_dir, partition_name or _ALL_PARTITIONS)
+        with open(file, "w", encoding="utf-8") as f:
+            f.write(str(time.time_ns()))
+        self.__signals[os.path.basename(file)] = os.stat(file).st_mtime_ns
+
+    def get(self, key: tuple) -> Optional[list[Document]]:
+        with self.__lock:
+            self.__check_signals()
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.__entries[key]
+                entry = None
+            if entry is None:
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            if self.__misses > 0:
+                self.__saved_latency += self.__miss_latency / self.__misses
+            return list(entry[1])
+
+    def put(self, key: tuple, docs: list[Document], latency: float = 0.0):
+        """Store a search result.
+
+        Args:
+            key: Key returned by `key`.
+            docs: Search result.
+            latency: Time the search took, used for the saved-latency metric.
+        """
+        with self.__lock:
+            self.__miss_latency += latency
+            if self.max_entries <= 0:
+                return
+            self.__entries[key] = (time.monotonic() + self.ttl, list(docs))
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, partition_name: Optional[str] = None):
+        """Drop the entries that searched the partition, or every entry if no partition is given, in every process."""
+        with self.__lock:
+            self.__drop(partition_name)
+            self.__signal(partition_name)
+
+    def __drop(self, partition_name: Optional[str]):
+        if partition_name is None:
+            self.__entries.clear()
+            return
+        for key in [key for key in self.__entries if key[1] is None or partition_name in key[1]]:
+            del self.__entries[key]
+
+    def stats(self) -> dict:
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "entries": len(self.__entries),
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups else 0.0,
+                "avg_miss_latency": self.__miss_latency / self.__misses if self.__misses else 0.0,
+                "saved_latency": self.__saved_latency,
+            }
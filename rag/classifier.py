@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import json
+import argparse
+from typing import Optional
+
+import numpy as np
+
+from rag.documents import section_map
+
+CHAT_LABEL = "Chat"
+OTHER_SECTIONS = {"Contest", "Tools", "Lang"}
+
+# Seed questions for the Chat class, which has no documents in the corpus.
+CHAT_SEEDS = [
+    "你好", "您好", "在吗", "谢谢", "谢谢你的回答", "再见", "你是谁", "你叫什么名字",
+    "你能做什么", "介绍一下你自己", "今天天气怎么样", "讲个笑话", "哈哈", "好的", "没问题",
+    "hello", "hi", "thanks", "who are you", "good morning",
+]
+
+# Labeled questions the softmax temperature is calibrated on, confidences have to hold for queries, not chunks.
+# None of them is used for the centroids, extend them with `--calibration` questions of real traffic.
+CALIBRATION_QUESTIONS = {
+    CHAT_LABEL: [
+        "早上好", "晚安", "你好呀", "多谢帮忙", "你是机器人吗", "你会聊天吗", "我今天心情不好", "拜拜",
+        "你喜欢什么颜色", "随便聊聊吧",
+    ],
+    "Basic": ["快速排序的时间复杂度是多少", "什么是前缀和", "二分查找怎么写", "贪心算法的正确性如何证明"],
+    "DP": ["动态规划的一些常见使用", "背包问题怎么做", "最长上升子序列怎么求", "区间 DP 的状态如何设计"],
+    "DS": ["线段树如何支持区间修改和区间查询", "并查集的路径压缩是什么", "树状数组的原理", "平衡树有哪些实现"],
+    "Geometry": ["如何求凸包", "判断两条线段是否相交", "旋转卡壳怎么用", "多边形面积怎么计算"],
+    "Graph": ["如何在有向图中求解从源节点到所有其他节点的最短路径？", "最小生成树有哪些算法", "Tarjan 求强连通分量", "网络流的最大流算法"],
+    "Math": ["逆元怎么计算？", "中国剩余定理是什么", "快速幂的原理", "如何用欧拉筛求素数"],
+    "Misc": ["离线算法和在线算法的区别", "莫队算法怎么用", "CDQ 分治是什么", "随机化算法有哪些技巧"],
+    "Search": ["深度优先搜索和广度优先搜索的区别", "A* 算法是什么", "双向搜索怎么实现", "搜索如何剪枝"],
+    "String": ["KMP 算法的 next 数组如何构造", "后缀数组怎么求", "字符串哈希如何避免冲突", "AC 自动机的原理"],
+    "Topic": ["有哪些经典的构造题思路", "博弈论中的 SG 函数", "分块的思想是什么", "交互题怎么调试"],
+    "Contest": ["NOIP 的比赛规则是什么", "ICPC 比赛怎么组队", "比赛时如何分配时间", "如何备战省选"],
+    "Tools": ["如何使用 GDB 调试程序", "对拍怎么写", "怎么配置 VS Code 写 C++", "评测机是怎么工作的"],
+    "Lang": ["C++ 的 STL 有哪些容器", "Python 的输入输出怎么加速", "C++ 中引用和指针的区别", "如何使用 Java 的 BigInteger"],
+}
+
+__classifier = None
+__classifier_loaded = False
+
+
+def get_classifier(
+        mode: Optional[str] = None or os.getenv("CLASSIFIER_MODE", "llm"),
+        path: Optional[str] = None or os.getenv("CLASSIFIER_PATH", "models/section_classifier.npz"),
+):
+    """Return the local classifier, or None when the LLM agents should be used."""
+    global __classifier, __classifier_loaded
+    if __classifier_loaded:
+        return __classifier
+    __classifier_loaded = True
+    if mode != "local":
+        return None
+    if not os.path.exists(path):
+        print(f"Classifier model {path} not found, falling back to the LLM agents.")
+        return None
+    print("Using SectionClassifier")
+    __classifier = SectionClassifier.load(path)
+    return __classifier
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class SectionClassifier:
+    """
+    Nearest-centroid intent and section classifier over query embeddings.
+
+    Each section is represented by the normalized mean of its chunk vectors,
+    the Chat class by the mean of a few seed questions. Cosine similarities are
+    turned into probabilities by a softmax whose temperature is fitted on
+    labeled questions, so the probabilities can be used as confidences. The
+    intent probabilities are the Chat probability, the mass of the Other
+    sections (Contest, Tools, Lang) and the mass of the remaining sections.
+    """
+
+    def __init__(
+            self,
+            labels: list[str],
+            centroids: np.ndarray,
+            temperature: float,
+            min_confidence: float = float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", 0.6)),
+            max_sections: int = 3,
+            section_ratio: float = 0.5,
+    ):
+        self.labels = list(labels)
+        self.centroids = _normalize(np.asarray(centroids, dtype=np.float32))
+        self.temperature = temperature
+        self.min_confidence = min_confidence
+        self.max_sections = max_sections
+        self.section_ratio = section_ratio
+
+    def probabilities(self, vectors: np.ndarray) -> np.ndarray:
+        sims = _normalize(np.asarray(vectors, dtype=np.float32)) @ self.centroids.T
+        return _softmax(sims / self.temperature)
+
+    def predict(self, vector: list[float]) -> dict:
+        """Classify a query embedding.
+
+        Args:
+            vector: Query embedding.
+
+        Returns:
+            Dict with the intent type, the related sections and the confidence
+            of both decisions, e.g.
+            {"type": "Algorithm", "components": ["DP"], "intent_confidence": 0.97, "section_confidence": 0.81}
+        """
+        probs = self.probabilities(np.asarray([vector]))[0]
+        chat_prob = float(probs[self.labels.index(CHAT_LABEL)]) if CHAT_LABEL in self.labels else 0.0
+        other_prob = float(sum(p for p, label in zip(probs, self.labels) if label in OTHER_SECTIONS))
+        intents = {CHAT_LABEL: chat_prob, "Other": other_prob, "Algorithm": max(1 - chat_prob - other_prob, 0.0)}
+        intent_type = max(intents, key=intents.get)
+
+        ranked = sorted(
+            ((float(p), label) for p, label in zip(probs, self.labels) if label != CHAT_LABEL),
+            reverse=True,
+        )
+        top_prob = ranked[0][0]
+        components = [
+            label for p, label in ranked[: self.max_sections] if p >= top_prob * self.section_ratio
+        ]
+        section_confidence = sum(p for p, label in ranked if label in components) / max(1 - chat_prob, 1e-12)
+
+        return {
+            "type": intent_type,
+            "components": components,
+            "intent_confidence": intents[intent_type],
+            "section_confidence": section_confidence,
+        }
+
+    @classmethod
+    def fit(
+            cls,
+            vectors: np.ndarray,
+            labels: list[str],
+            calibration_vectors: np.ndarray,
+            calibration_labels: list[str],
+    ) -> "SectionClassifier":
+        """Fit the centroids and calibrate the softmax temperature.
+
+        Args:
+            vectors: Training vectors, one per row.
+            labels: Label of each training vector.
+            calibration_vectors: Question vectors the temperature is fitted on, one per row.
+            calibration_labels: Label of each question, questions of unknown labels are skipped.
+        """
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        labels = np.asarray(labels)
+        names = [name for name in list(section_map) + [CHAT_LABEL] if name in set(labels)]
+
+        centroids = np.stack([vectors[labels == name].mean(axis=0) for name in names])
+        model = cls(names, centroids, temperature=1.0)
+
+        known = [i for i, label in enumerate(calibration_labels) if label in names]
+        if not known:
+            print("No calibration question matches a trained label, keeping temperature 1.0")
+            return model
+        sims = _normalize(np.asarray(calibration_vectors, dtype=np.float32)[known]) @ model.centroids.T
+        targets = np.array([names.index(calibration_labels[i]) for i in known])
+        best_nll = np.inf
+        for temperature in np.logspace(-3, 0, 61):
+            probs = _softmax(sims / temperature)
+            nll = -np.mean(np.log(probs[np.arange(len(targets)), targets] + 1e-12))
+            if nll < best_nll:
+                best_nll, model.temperature = nll, float(temperature)
+
+        intents = [model.predict(vector)["type"] for vector in np.asarray(calibration_vectors)[known]]
+        expected = [
+            label if label == CHAT_LABEL else "Other" if label in OTHER_SECTIONS else "Algorithm"
+            for label in (calibration_labels[i] for i in known)
+        ]
+        print(
+            f"Calibrated temperature {model.temperature:.4f} on {len(known)} questions, "
+            f"section accuracy {np.mean(np.argmax(sims, axis=1) == targets):.3f}, "
+            f"intent accuracy {np.mean(np.asarray(intents) == np.asarray(expected)):.3f}"
+        )
+        return model
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(
+            path,
+            labels=np.asarray(self.labels),
+            centroids=self.centroids,
+            temperature=np.asarray(self.temperature),
+        )
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "SectionClassifier":
+        data = np.load(path)
+        return cls(
+            [str(label) for label in data["labels"]],
+            data["centroids"],
+            float(data["temperature"]),
+            **kwargs,
+        )
+
+
+def train_from_corpus(output: str, max_per_section: int = 0, calibration: Optional[str] = None):
+    """Train the classifier from the chunk vectors indexed in OceanBase."""
+    from rag.embeddings import get_embedding
+    from utils.connect_oceanbse import iter_corpus
+
+    code_to_section = {code: name for name, code in section_map.items()}
+    counts = {}
+    vectors, labels = [], []
+    for row in iter_corpus():
+        section = code_to_section.get(row["section_code"])
+        if section is None:
+            continue
+        if 0 < max_per_section <= counts.get(section, 0):
+            continue
+        counts[section] = counts.get(section, 0) + 1
+        vectors.append(row["embedding"])
+        labels.append(section)
+    print("Training vectors per section:", counts)
+
+    embedding = get_embedding()
+    chat_vectors = embedding.embed_documents(CHAT_SEEDS)
+    vectors.extend(chat_vectors)
+    labels.extend([CHAT_LABEL] * len(chat_vectors))
+
+    questions = [(question, label) for label, items in CALIBRATION_QUESTIONS.items() for question in items]
+    if calibration:
+        with open(calibration, "r", encoding="utf-8") as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        questions.extend((item["question"], item["label"]) for item in items)
+    calibration_vectors = embedding.embed_documents([question for question, _ in questions])
+
+    model = SectionClassifier.fit(
+        np.asarray(vectors, dtype=np.float32),
+        labels,
+        np.asarray(calibration_vectors, dtype=np.float32),
+        [label for _, label in questions],
+    )
+    model.save(output)
+    print(f"Classifier saved to {output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the local intent and section classifier.")
+    parser.add_argument("--output", default=os.getenv("CLASSIFIER_PATH", "models/section_classifier.npz"))
+    parser.add_argument("--max-per-section", type=int, default=0)
+    parser.add_argument(
+        "--calibration", help="JSONL file of {\"question\", \"label\"} added to the built-in calibration questions"
+    )
+    args = parser.parse_args()
+    train_from_corpus(args.output, args.max_per_section, args.calibration)
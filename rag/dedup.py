@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from langchain_core.documents import Document
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+class NearDuplicateFilter:
+    """
+    MinHash/LSH near-duplicate chunk detector.
+
+    Each chunk is turned into a MinHash signature of its character shingles.
+    Signatures are split into bands and only chunks sharing a band bucket are
+    compared, so candidates are found in roughly linear time instead of
+    comparing every pair. A chunk whose estimated Jaccard similarity to an
+    earlier kept chunk reaches the threshold is dropped, and the kept chunk
+    records the urls of every page it stands for in `source_urls`.
+
+    Every call of `dedup` is independent: retrieval is partitioned by section,
+    so a chunk shared by two sections has to stay in both. One filter can be
+    used for every section, `total` sums up the reports of all calls.
+    """
+
+    def __init__(
+            self,
+            threshold: float = 0.85,
+            num_perm: int = 128,
+            bands: int = 16,
+            shingle_size: int = 5,
+            seed: int = 0,
+    ):
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm {num_perm} is not a multiple of bands {bands}.")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.__a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.__b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.__input_chunks = 0
+        self.__kept_chunks = 0
+        self.__removed_chars = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        text = re.sub(r"\s+", " ", text.strip().lower())
+        n = self.shingle_size
+        shingles = {text[i: i + n] for i in range(max(len(text) - n + 1, 1))}
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        permuted = (hashes[:, None] * self.__a[None, :] + self.__b[None, :]) % _MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    def dedup(self, docs: list[Document]) -> tuple[list[Document], dict]:
+        """Collapse near-duplicate chunks.
+
+        Args:
+            docs: Chunks in ingestion order, the first of each group of near duplicates is kept.
+
+        Returns:
+            The kept chunks and a report of how much the chunk list shrank.
+        """
+        kept: list[Document] = []
+        signatures: list[np.ndarray] = []
+        buckets = defaultdict(list)
+        removed_chars = 0
+
+        for doc in docs:
+            signature = self.signature(doc.page_content)
+            keys = [
+                (band, signature[band * self.rows: (band + 1) * self.rows].tobytes())
+                for band in range(self.bands)
+            ]
+
+            canonical = None
+            for idx in dict.fromkeys(i for key in keys for i in buckets.get(key, [])):
+                if np.mean(signatures[idx] == signature) >= self.threshold:
+                    canonical = idx
+                    break
+
+            if canonical is None:
+                idx = len(kept)
+                doc.metadata = {**doc.metadata, "source_urls": [doc.metadata.get("doc_url", "")]}
+                kept.append(doc)
+                signatures.append(signature)
+                for key in keys:
+                    buckets[key].append(idx)
+                continue
+
+            removed_chars += len(doc.page_content)
+            sources = kept[canonical].metadata["source_urls"]
+            url = doc.metadata.get("doc_url", "")
+            if url not in sources:
+                sources.append(url)
+
+        self.__input_chunks += len(docs)
+        self.__kept_chunks += len(kept)
+        self.__removed_chars += removed_chars
+        return kept, self._report(len(docs), len(kept), removed_chars)
+
+    def total(self) -> dict:
+        """Report over every chunk passed to `dedup` so far."""
+        return self._report(self.__input_chunks, self.__kept_chunks, self.__removed_chars)
+
+    @staticmethod
+    def _report(input_chunks: int, kept_chunks: int, removed_chars: int) -> dict:
+        return {
+            "input_chunks": input_chunks,
+            "kept_chunks": kept_chunks,
+            "removed_chunks": input_chunks - kept_chunks,
+            "removed_ratio": (input_chunks - kept_chunks) / input_chunks if input_chunks else 0.0,
+            "removed_chars": removed_chars,
+        }
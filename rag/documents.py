@@ -9,6 +9,8 @@ from langchain_core.documents import Document
 from typing import Iterator, List
 from pathlib import Path
 
+OI_WIKI_BASE_URL = os.getenv("OI_WIKI_BASE_URL", "https://oi-wiki.org/")
+
 
 class DocumentMeta(BaseModel):
     """
@@ -22,6 +24,44 @@ class DocumentMeta(BaseModel):
     doc_name: str
     chunk_title: str
     enhanced_title: str
+    source_path: str = ""
+
+
+def canonical_url(file_path: str, base_url: str = OI_WIKI_BASE_URL) -> str:
+    """Public OI Wiki url of a markdown file, e.g. doc/docs/dp/basic.md -> https://oi-wiki.org/dp/basic/
+
+    The path below the last `docs` directory is used, with either path separator.
+    """
+    parts = [p for p in re.split(r"[\\/]+", file_path) if p and p != "."]
+    if "docs" in parts:
+        parts = parts[len(parts) - parts[::-1].index("docs"):]
+    if parts:
+        stem, ext = os.path.splitext(parts[-1])
+        if ext in {".md", ".mdx"}:
+            parts[-1] = stem
+        if parts[-1] == "index":
+            parts.pop()
+    return base_url.rstrip("/") + "/" + "".join(p + "/" for p in parts)
+
+
+class Citation:
+    """
+    Citation of a retrieved chunk, read from the metadata precomputed at ingest time.
+    """
+
+    __slots__ = ("url", "title")
+
+    def __init__(self, url: str, title: str):
+        self.url = url
+        self.title = title
+
+    @classmethod
+    def from_metadata(cls, metadata: dict) -> "Citation":
+        url = metadata.get("doc_url", "")
+        if not url.startswith(("http://", "https://")):
+            # Chunks ingested before canonical urls were stored keep the raw file path.
+            url = canonical_url(url)
+        return cls(url, metadata.get("doc_name") or metadata.get("chunk_title", url))
 
 
 section_map = {
@@ -60,14 +100,16 @@ def parse_md(file_path: str, max_chunk_size: int = 4096) -> Iterator[Document]:
         file_content = f.read()
 
     chunks = splitter.split_text(file_content)
-    filename = os.path.basename(file_path)  # todo 此处可以修改成标准链接
+    filename = os.path.basename(file_path)
+    doc_url = canonical_url(file_path)
 
     for chunk in chunks:
         metadata_values = list(chunk.metadata.values())
         default_title = metadata_values[-1] if metadata_values else filename
 
         meta = DocumentMeta(
-            doc_url=file_path,
+            doc_url=doc_url,
+            source_path=file_path,
             chunk_title=default_title,
             enhanced_title=" -> ".join(metadata_values) if metadata_values else default_title,
             doc_name=chunk.metadata.get("Header1", default_title),
@@ -108,4 +150,4 @@ class MarkdownDocumentsLoader:
                 yield chunk
             if 0 < limit <= count:
                 print(f"Limit reached: {limit}, exiting early.")
-                exit(0)
+                return
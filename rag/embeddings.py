@@ -8,6 +8,9 @@ from typing import List, Union, Optional
 from langchain_core.embeddings import Embeddings
 from langchain_core.documents import Document
 from dotenv import load_dotenv
+from rag.passage_store import get_passage_store
+from utils.rate_limit import get_limiter
+from utils.tokens import count_tokens
 
 load_dotenv()
 
@@ -21,6 +24,8 @@ def get_embedding(
         base_url: Optional[str] = None or os.getenv("OPENAI_EMBEDDING_BASE_URL"),
         api_key: Optional[str] = None or os.getenv("OPENAI_EMBEDDING_API_KEY"),
         model: Optional[str] = None or os.getenv("OPENAI_EMBEDDING_MODEL"),
+        dimensions: int = 1024,
+        bge_backend: str = os.getenv("BGE_BACKEND", "torch"),
 ):
     global __embedding
     if __embedding is not None:
@@ -38,7 +43,11 @@ def get_embedding(
             base_url=base_url,
             api_key=api_key,
             model=model,
+            dimensions=dimensions,
         )
+    elif bge_backend == "onnx":
+        print("Using ONNXBGEEmbedding")
+        __embedding = ONNXBGEEmbedding()
     else:
         print("Using BGEEmbedding")
         __embedding = BGEEmbedding()
@@ -75,6 +84,9 @@ class RemoteOpenAI(Embeddings):
         Returns:
             List of embeddings.
         """
+        limiter = get_limiter("embedding")
+        if not limiter.unlimited:
+            limiter.acquire(sum(count_tokens(text) for text in texts))
         res = requests.post(
             f"{self._base_url}",
             headers={
@@ -191,9 +203,29 @@ class BGEEmbedding(Embeddings):
         embed_res = self.embed_documents([text], **kwargs)
         return embed_res[0]
 
+    def store_passages(self, texts: List[str], max_passage_length: int = 8192):
+        """Encode the passages missing from the passage store and add them to it."""
+        store = get_passage_store()
+        texts = store.missing(texts) if store is not None else []
+        if not texts:
+            return
+        embed_res = self.__model.encode(
+            texts,
+            batch_size=1,
+            max_length=max_passage_length,
+            return_dense=True,
+            return_sparse=True,
+            return_colbert_vecs=True,
+        )
+        store.add(texts, embed_res)
+
     def rerank(self, query: str, documents: List[Document]) -> List[Document]:
         """Rerank documents.
 
+        With a passage store only the query is encoded, the documents are scored
+        against their stored representations, see PassageVectorStore.scores.
+        Documents missing from the store are encoded and stored first.
+
         Args:
             query: Query text.
             documents: List of documents to rerank.
@@ -203,26 +235,164 @@ class BGEEmbedding(Embeddings):
         """
         if len(documents) == 0:
             return documents
-        pairs = list(
-            zip([query] * len(documents), [doc.page_content for doc in documents])
-        )
-        score_res = self.__model.compute_score(
-            pairs,
-            batch_size=1,
-            max_query_length=512,
-            max_passage_length=8192,
-            weights_for_different_modes=[
-                self.__dense_weight,
-                self.__sparse_weight,
-                self.__colbert_weight,
-            ],
-        )
-        scores = score_res["colbert+sparse+dense"]
+        weights = (self.__dense_weight, self.__sparse_weight, self.__colbert_weight)
+        texts = [doc.page_content for doc in documents]
+
+        scores = None
+        store = get_passage_store()
+        if store is not None:
+            self.store_passages(texts)
+            query_res = self.__model.encode(
+                [query],
+                batch_size=1,
+                max_length=512,
+                return_dense=True,
+                return_sparse=True,
+                return_colbert_vecs=True,
+            )
+            scores = store.scores({key: value[0] for key, value in query_res.items()}, texts, weights)
+        if scores is None:
+            score_res = self.__model.compute_score(
+                list(zip([query] * len(documents), texts)),
+                batch_size=1,
+                max_query_length=512,
+                max_passage_length=8192,
+                weights_for_different_modes=list(weights),
+            )
+            scores = score_res["colbert+sparse+dense"]
         docs_with_scores = list(zip(scores, documents))
         combined_sorted = sorted(docs_with_scores, key=lambda x: x[0], reverse=True)
         return [doc for _, doc in combined_sorted]
 
 
+class ONNXBGEEmbedding(Embeddings):
+    """
+    BGE-M3 dense and sparse encoding on CPU through an ONNX graph exported by
+    `python -m rag.bge_onnx export`, optionally dynamically quantized to int8.
+    """
+
+    EmbeddingType = BGEEmbedding.EmbeddingType
+
+    def __init__(
+            self,
+            model_dir: str = os.getenv("BGE_ONNX_PATH", "models/bge-m3-onnx"),
+            quantized: bool = os.getenv("BGE_ONNX_INT8", "true").lower() in ("1", "true", "yes"),
+            num_threads: int = int(os.getenv("BGE_NUM_THREADS", 0)),
+            default_embedding_type: EmbeddingType = EmbeddingType.Dense,
+            max_length: int = 512,
+            batch_size: int = 16,
+    ):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except Exception as e:
+            print("Module onnxruntime or transformers not found, please execute `pip install onnxruntime transformers` first")
+            exit(1)
+        model_file = os.path.join(model_dir, "model.int8.onnx" if quantized else "model.onnx")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.__session = ort.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.__tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.__unused_tokens = {
+            self.__tokenizer.cls_token_id,
+            self.__tokenizer.eos_token_id,
+            self.__tokenizer.pad_token_id,
+            self.__tokenizer.unk_token_id,
+        }
+        self.__default_embedding_type = default_embedding_type
+        self.max_length = max_length
+        self.batch_size = batch_size
+
+    def encode(self, texts: List[str], return_dense: bool = True, return_sparse: bool = False) -> dict:
+        """Encode texts like BGEM3FlagModel.encode, with dense_vecs and lexical_weights outputs."""
+        import numpy as np
+
+        dense = [None] * len(texts)
+        sparse = [None] * len(texts)
+        # Batch texts of similar length together to keep padding small.
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start: start + self.batch_size]
+            inputs = self.__tokenizer(
+                [texts[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            dense_vecs, token_weights = self.__session.run(
+                ["dense_vecs", "sparse_weights"],
+                {
+                    "input_ids": inputs["input_ids"].astype(np.int64),
+                    "attention_mask": inputs["attention_mask"].astype(np.int64),
+                },
+            )
+            for row, i in enumerate(batch):
+                dense[i] = dense_vecs[row]
+                if return_sparse:
+                    weights = {}
+                    for token_id, weight in zip(inputs["input_ids"][row], token_weights[row]):
+                        if token_id in self.__unused_tokens or weight <= 0:
+                            continue
+                        key = str(int(token_id))
+                        weights[key] = max(weights.get(key, 0.0), float(weight))
+                    sparse[i] = weights
+        return {
+            "dense_vecs": dense if return_dense else None,
+            "lexical_weights": sparse if return_sparse else None,
+        }
+
+    def embed_documents(
+            self,
+            texts: List[str],
+            *,
+            embedding_type: Union[EmbeddingType, None] = None,
+    ) -> Union[List[List[float]], List[dict[int, float]]]:
+        """Embed search docs.
+
+        Args:
+            texts: List of text to embed.
+            embedding_type: Type of embedding to return. Defaults to EmbeddingType.Dense.
+
+        Returns:
+            List of embeddings.
+        """
+        embedding_type = embedding_type or self.__default_embedding_type
+
+        do_dense = embedding_type in [
+            self.EmbeddingType.Dense,
+            self.EmbeddingType.Both,
+        ]
+        do_sparse = embedding_type in [
+            self.EmbeddingType.Sparse,
+            self.EmbeddingType.Both,
+        ]
+
+        embed_res = self.encode(texts, return_dense=do_dense, return_sparse=do_sparse)
+        if do_sparse and do_dense:
+            dense = [embedding.tolist() for embedding in embed_res["dense_vecs"]]
+            sparse = embed_res["lexical_weights"]
+            return dense, sparse
+        elif do_dense:
+            return [embedding.tolist() for embedding in embed_res["dense_vecs"]]
+        else:
+            return embed_res["lexical_weights"]
+
+    def embed_query(self, text: str, **kwargs) -> Union[List[float], dict[int, float]]:
+        """Embed query text.
+
+        Args:
+            text: Text to embed.
+
+        Returns:
+            Embedding.
+        """
+        embed_res = self.embed_documents([text], **kwargs)
+        return embed_res[0]
+
+
 class OllamaEmbedding(Embeddings):
     def __init__(self, url: str, token: str, model: str = "bge-m3"):
         self.url = url
@@ -233,6 +403,9 @@ class OllamaEmbedding(Embeddings):
             self,
             texts: List[str],
     ) -> Union[List[List[float]], List[dict[int, float]]]:
+        limiter = get_limiter("embedding")
+        if not limiter.unlimited:
+            limiter.acquire(sum(count_tokens(text) for text in texts))
         res = requests.post(
             self.url,
             json={"model": self.model, "input": texts},
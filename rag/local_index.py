@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import numpy as np
+
+METRICS = ("l2", "cosine", "inner_product")
+
+
+def _scores(base: np.ndarray, queries: np.ndarray, metric: str, sq_norms: np.ndarray = None) -> np.ndarray:
+    """Similarity of every query to every base vector, larger is closer."""
+    if metric == "l2":
+        if sq_norms is None:
+            sq_norms = np.sum(base * base, axis=1)
+        return 2 * queries @ base.T - sq_norms[None, :]
+    if metric == "cosine":
+        base = base / np.maximum(np.linalg.norm(base, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    return queries @ base.T
+
+
+def _topk(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+def exact_topk(
+        base: np.ndarray,
+        queries: np.ndarray,
+        k: int,
+        metric: str = "l2",
+        batch_size: int = 256,
+) -> np.ndarray:
+    """Brute-force top-k neighbour indices of each query, computed in query batches."""
+    base = np.asarray(base, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    return np.concatenate([
+        _topk(_scores(base, queries[i: i + batch_size], metric), k)
+        for i in range(0, len(queries), batch_size)
+    ]) if len(queries) else np.empty((0, k), dtype=np.int64)
+
+
+class FlatIndex:
+    """
+    Exact in-process vector index.
+    """
+
+    def __init__(self, vectors: np.ndarray, metric: str = "l2"):
+        if metric not in METRICS:
+            raise ValueError(f"metric {metric} not in {METRICS}.")
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.metric = metric
+        self.sq_norms = None
+        if metric == "l2":
+            self.sq_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        elif metric == "cosine":
+            # Normalize once so that searches are plain inner products.
+            self.vectors = self.vectors / np.maximum(np.linalg.norm(self.vectors, axis=1, keepdims=True), 1e-12)
+
+    def search(self, query: np.ndarray, k: int, candidates: np.ndarray = None) -> np.ndarray:
+        """Return the indices of the k nearest vectors, optionally among the candidate indices only."""
+        query = np.asarray(query, dtype=np.float32)[None, :]
+        metric = "inner_product" if self.metric == "cosine" else self.metric
+        if candidates is None:
+            return _topk(_scores(self.vectors, query, metric, self.sq_norms), k)[0]
+        candidates = np.asarray(candidates)
+        if len(candidates) == 0:
+            return candidates
+        sq_norms = self.sq_norms[candidates] if self.sq_norms is not None else None
+        return candidates[_topk(_scores(self.vectors[candidates], query, metric, sq_norms), k)[0]]
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate index: vectors are bucketed by k-means centroid
+    and a query only scans the buckets of its nprobe closest centroids.
+    """
+
+    def __init__(
+            self,
+            vectors: np.ndarray,
+            nlist: int = 256,
+            nprobe: int = 8,
+            metric: str = "l2",
+            iterations: int = 10,
+            seed: int = 0,
+    ):
+        self.flat = FlatIndex(vectors, metric)
+        self.nprobe = nprobe
+        vectors = self.flat.vectors
+        nlist = max(1, min(nlist, len(vectors)))
+
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), size=min(len(vectors), nlist * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assign = exact_topk(centroids, sample, 1, "l2")[:, 0]
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members) > 0:
+                    centroids[c] = members.mean(axis=0)
+        self.centroids = centroids
+
+        assign = exact_topk(centroids, vectors, 1, "l2")[:, 0]
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        self.lists = [order[bounds[c]: bounds[c + 1]] for c in range(nlist)]
+
+    def search(self, query: np.ndarray, k: int) -> np.ndarray:
+        query = np.asarray(query, dtype=np.float32)
+        probes = exact_topk(self.centroids, query[None, :], self.nprobe, "l2")[0]
+        candidates = np.concatenate([self.lists[c] for c in probes])
+        return self.flat.search(query, k, candidates)
+
+
+def truncate_normalize(vectors: np.ndarray, dim: int, batch_size: int = 65536) -> np.ndarray:
+    """Keep the first dim components of each vector and renormalize them to unit length."""
+    out = np.empty((len(vectors), dim), dtype=np.float32)
+    for i in range(0, len(vectors), batch_size):
+        block = np.asarray(vectors[i: i + batch_size, :dim], dtype=np.float32)
+        out[i: i + batch_size] = block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+    return out
+
+
+class TwoStageIndex:
+    """
+    Two-stage index: an exact search over truncated, renormalized low-dimensional
+    vectors selects a shortlist, which is rescored with the full vectors.
+
+    Only the low-dimensional copy is scanned per query, the full vectors (e.g. a
+    memory-mapped snapshot block) are read for the shortlist rows only.
+    """
+
+    def __init__(
+            self,
+            vectors: np.ndarray,
+            coarse_vectors: np.ndarray = None,
+            dim: int = 256,
+            shortlist: int = 100,
+            metric: str = "l2",
+    ):
+        if coarse_vectors is None:
+            coarse_vectors = truncate_normalize(vectors, dim)
+        self.vectors = vectors
+        self.dim = coarse_vectors.shape[1]
+        self.coarse = FlatIndex(coarse_vectors, "inner_product")
+        self.shortlist = shortlist
+        self.metric = metric
+
+    def search(self, query: np.ndarray, k: int, candidates: np.ndarray = None) -> np.ndarray:
+        query = np.asarray(query, dtype=np.float32)
+        coarse_query = query[: self.dim] / max(float(np.linalg.norm(query[: self.dim])), 1e-12)
+        shortlist = np.sort(self.coarse.search(coarse_query, max(self.shortlist, k), candidates))
+        if len(shortlist) == 0:
+            return shortlist
+        full = np.asarray(self.vectors[shortlist], dtype=np.float32)
+        return shortlist[_topk(_scores(full, query[None, :], self.metric), k)[0]]
@@ -0,0 +1,310 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import json
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+PASSAGE_STORE_VERSION = 1
+
+__passage_store = None
+__passage_store_lock = threading.Lock()
+
+# Files of a passage store directory. Every entry is one fixed-size row of
+# entries.bin holding the content hash of the passage and the offsets of its
+# rows in the float16 blocks: `dense_row`, `colbert_len` multi-vector rows and
+# `sparse_len` (token id, weight) pairs. All blocks are append-only.
+MANIFEST_FILE = "manifest.json"
+ENTRIES_FILE = "entries.bin"
+DENSE_FILE = "dense.f16"
+COLBERT_FILE = "colbert.f16"
+SPARSE_IDS_FILE = "sparse_ids.i32"
+SPARSE_WEIGHTS_FILE = "sparse_weights.f16"
+LOCK_FILE = "append.lock"
+
+ENTRY_DTYPE = np.dtype([
+    ("key", "S16"),
+    ("dense_row", "<i8"),
+    ("colbert_offset", "<i8"),
+    ("colbert_len", "<i4"),
+    ("sparse_offset", "<i8"),
+    ("sparse_len", "<i4"),
+])
+
+
+def get_passage_store():
+    """The passage store at PASSAGE_STORE_PATH, or None if the path is empty."""
+    global __passage_store
+    with __passage_store_lock:
+        path = os.getenv("PASSAGE_STORE_PATH", "passages")
+        if __passage_store is None and path:
+            __passage_store = PassageVectorStore(path, dimension=int(os.getenv("PASSAGE_STORE_DIM", 1024)))
+        return __passage_store
+
+
+class _View:
+    """Immutable mapping of the store files, replaced as a whole after every append."""
+
+    __slots__ = ("entries", "dense", "colbert", "sparse_ids", "sparse_weights", "index")
+
+    def __init__(self, entries, dense, colbert, sparse_ids, sparse_weights):
+        self.entries = entries
+        self.dense = dense
+        self.colbert = colbert
+        self.sparse_ids = sparse_ids
+        self.sparse_weights = sparse_weights
+        self.index = {bytes(key): i for i, key in enumerate(entries["key"])}
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Exclusive lock on a file, held across processes."""
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def passage_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class PassageVectorStore:
+    """
+    Memory-mapped BGE-M3 dense, sparse and multi-vector (ColBERT) representations
+    of passages, keyed by a hash of their content.
+
+    Passages are encoded once at ingest time and stored in float16, so rerank
+    only has to encode the query and scores the candidates by vectorized late
+    interaction against the stored token vectors.
+
+    Several processes may append to the same directory, e.g. the loader and
+    the app. Appends hold a file lock and take their offsets from the files on
+    disk, readers remap once entries.bin has grown.
+    """
+
+    def __init__(self, path: str, dimension: int = 1024):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                dimension = json.load(f)["dimension"]
+        else:
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump({"version": PASSAGE_STORE_VERSION, "dimension": dimension}, f, indent=2)
+        self.dimension = dimension
+        self.__lock = threading.Lock()
+        self.__remap()
+
+    def _map(self, name: str, dtype, width: int = 0) -> np.ndarray:
+        file = os.path.join(self.path, name)
+        dtype = np.dtype(dtype)
+        row_bytes = dtype.itemsize * max(width, 1)
+        rows = os.path.getsize(file) // row_bytes if os.path.exists(file) else 0
+        shape = (rows, width) if width else (rows,)
+        if rows == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(file, dtype=dtype, mode="r", shape=shape)
+
+    def __remap(self):
+        # Readers take one reference to the view, so they never mix the index of one append with the blocks of another.
+        self.__view = _View(
+            self._map(ENTRIES_FILE, ENTRY_DTYPE),
+            self._map(DENSE_FILE, "<f2", self.dimension),
+            self._map(COLBERT_FILE, "<f2", self.dimension),
+            self._map(SPARSE_IDS_FILE, "<i4"),
+            self._map(SPARSE_WEIGHTS_FILE, "<f2"),
+        )
+
+    def _current_view(self) -> _View:
+        """The view, remapped first if another process appended entries."""
+        view = self.__view
+        file = os.path.join(self.path, ENTRIES_FILE)
+        rows = os.path.getsize(file) // ENTRY_DTYPE.itemsize if os.path.exists(file) else 0
+        if rows != len(view.entries):
+            with self.__lock:
+                self.__remap()
+                view = self.__view
+        return view
+
+    def _truncate_partial_rows(self):
+        """Cut off the partial last row an interrupted write may have left, so that appends stay aligned."""
+        for name, row_bytes in (
+                (ENTRIES_FILE, ENTRY_DTYPE.itemsize),
+                (DENSE_FILE, 2 * self.dimension),
+                (COLBERT_FILE, 2 * self.dimension),
+                (SPARSE_IDS_FILE, 4),
+                (SPARSE_WEIGHTS_FILE, 2),
+        ):
+            file = os.path.join(self.path, name)
+            if os.path.exists(file) and os.path.getsize(file) % row_bytes:
+                os.truncate(file, os.path.getsize(file) // row_bytes * row_bytes)
+
+    def __len__(self) -> int:
+        return len(self._current_view().index)
+
+    def __contains__(self, text: str) -> bool:
+        return passage_key(text) in self._current_view().index
+
+    def missing(self, texts: list[str]) -> list[str]:
+        """Distinct texts that are not stored yet."""
+        index = self._current_view().index
+        return list(dict.fromkeys(text for text in texts if passage_key(text) not in index))
+
+    def add(self, texts: list[str], encoded: dict):
+        """Append passages.
+
+        Args:
+            texts: Passage texts.
+            encoded: Output of BGEM3FlagModel.encode with dense_vecs, lexical_weights and colbert_vecs.
+        """
+        with self.__lock, _file_lock(os.path.join(self.path, LOCK_FILE)):
+            # Offsets come from the files as other processes left them, not from the view of this one.
+            self._truncate_partial_rows()
+            self.__remap()
+            view = self.__view
+            dense_row = len(view.dense)
+            colbert_offset = len(view.colbert)
+            sparse_offset = len(view.sparse_ids)
+            entries, dense, colbert, sparse_ids, sparse_weights = [], [], [], [], []
+            seen = set(view.index)
+            for text, dense_vec, lexical, colbert_vecs in zip(
+                    texts, encoded["dense_vecs"], encoded["lexical_weights"], encoded["colbert_vecs"]
+            ):
+                key = passage_key(text)
+                if key in seen:
+                    continue
+                seen.add(key)
+                colbert_vecs = np.asarray(colbert_vecs, dtype="<f2").reshape(-1, self.dimension)
+                ids = np.asarray([int(token) for token in lexical], dtype="<i4")
+                entries.append((key, dense_row, colbert_offset, len(colbert_vecs), sparse_offset, len(ids)))
+                dense.append(np.asarray(dense_vec, dtype="<f2"))
+                colbert.append(colbert_vecs)
+                sparse_ids.append(ids)
+                sparse_weights.append(np.asarray(list(lexical.values()), dtype="<f2"))
+                dense_row += 1
+                colbert_offset += len(colbert_vecs)
+                sparse_offset += len(ids)
+            if not entries:
+                return
+
+            # Data blocks are written before the entries, so an interrupted write never leaves an entry dangling.
+            for name, blocks in (
+                    (DENSE_FILE, dense),
+                    (COLBERT_FILE, colbert),
+                    (SPARSE_IDS_FILE, sparse_ids),
+                    (SPARSE_WEIGHTS_FILE, sparse_weights),
+            ):
+                with open(os.path.join(self.path, name), "ab") as f:
+                    for block in blocks:
+                        f.write(block.tobytes())
+            with open(os.path.join(self.path, ENTRIES_FILE), "ab") as f:
+                f.write(np.asarray(entries, dtype=ENTRY_DTYPE).tobytes())
+            self.__remap()
+
+    def scores(self, query: dict, texts: list[str], weights: tuple[float, float, float]) -> Optional[np.ndarray]:
+        """Score stored passages against an encoded query like BGEM3FlagModel.compute_score.
+
+        Args:
+            query: Encoded query with dense_vecs, lexical_weights and colbert_vecs of one text.
+            texts: Candidate passages, all of them must be stored.
+            weights: Weights of the dense, sparse and ColBERT scores.
+
+        Returns:
+            The weighted "colbert+sparse+dense" score of every passage, or None if one is not stored.
+        """
+        view = self._current_view()
+        rows = [view.index.get(passage_key(text)) for text in texts]
+        if any(row is None for row in rows):
+            return None
+        rows = np.asarray(rows)
+        entries = view.entries[rows]
+        n = len(rows)
+
+        dense = np.asarray(view.dense[entries["dense_row"]], dtype=np.float32) @ np.asarray(
+            query["dense_vecs"], dtype=np.float32
+        )
+
+        # Lexical matching: sum of query weight * passage weight over the shared tokens.
+        query_ids = np.asarray([int(token) for token in query["lexical_weights"]], dtype=np.int64)
+        query_weights = np.asarray(list(query["lexical_weights"].values()), dtype=np.float32)
+        order = np.argsort(query_ids)
+        query_ids, query_weights = query_ids[order], query_weights[order]
+        ids = np.concatenate([view.sparse_ids[o: o + l] for o, l in entries[["sparse_offset", "sparse_len"]]])
+        weights_p = np.concatenate(
+            [view.sparse_weights[o: o + l] for o, l in entries[["sparse_offset", "sparse_len"]]]
+        ).astype(np.float32)
+        labels = np.repeat(np.arange(n), entries["sparse_len"])
+        sparse = np.zeros(n, dtype=np.float32)
+        if len(ids) and len(query_ids):
+            pos = np.clip(np.searchsorted(query_ids, ids), 0, len(query_ids) - 1)
+            matched = query_ids[pos] == ids
+            sparse = np.bincount(labels[matched], weights=weights_p[matched] * query_weights[pos[matched]], minlength=n)
+
+        # Late interaction: every query token takes its best passage token, averaged over the query tokens.
+        query_colbert = np.asarray(query["colbert_vecs"], dtype=np.float32).reshape(-1, self.dimension)
+        lengths = entries["colbert_len"]
+        colbert = np.zeros(n, dtype=np.float32)
+        nonempty = lengths > 0
+        if nonempty.any() and len(query_colbert):
+            tokens = np.concatenate(
+                [view.colbert[o: o + l] for o, l in entries[["colbert_offset", "colbert_len"]][nonempty]]
+            ).astype(np.float32)
+            similarities = query_colbert @ tokens.T
+            starts = np.concatenate([[0], np.cumsum(lengths[nonempty])[:-1]])
+            colbert[nonempty] = np.maximum.reduceat(similarities, starts, axis=1).sum(axis=0) / len(query_colbert)
+
+        w_dense, w_sparse, w_colbert = weights
+        return (dense * w_dense + sparse * w_sparse + colbert * w_colbert) / (w_dense + w_sparse + w_colbert)
+
+
+def build_passage_store(batch_size: int = 16, partition_names: list[str] = None):
+    """Encode the passages of the corpus table that are not in the passage store yet."""
+    from rag.embeddings import BGEEmbedding, get_embedding
+    from utils.connect_oceanbse import iter_corpus
+
+    embedding = get_embedding()
+    if not isinstance(embedding, BGEEmbedding):
+        print("The passage store needs the local BGE-M3 model, configure BGE_MODEL_PATH without remote embeddings.")
+        exit(1)
+    store = get_passage_store()
+    batch = []
+    for row in iter_corpus(batch_size=1000, partition_names=partition_names, with_vectors=False, with_content=True):
+        batch.append(row["document"])
+        if len(batch) >= batch_size:
+            embedding.store_passages(batch)
+            batch = []
+    if batch:
+        embedding.store_passages(batch)
+    print(f"{len(store)} passages in {store.path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute BGE-M3 passage representations for rerank.")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--partitions", nargs="*", help="only these sections")
+    args = parser.parse_args()
+    build_passage_store(args.batch_size, args.partitions)
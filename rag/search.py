@@ -1,34 +1,104 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
+import os
 import re
 import time
 
 from typing import Iterator, Union
 from langchain_core.messages import AIMessageChunk
 from rag.embeddings import get_embedding
-from rag.documents import Document, DocumentMeta, section_map
-from utils.connect_oceanbse import connect_oceanbase
+from rag.classifier import get_classifier
+from rag.cache import get_retrieval_cache
+from rag.snapshot import get_local_store
+from rag.streaming import coalesce_chunks
+from rag.singleflight import get_single_flight
+from rag.documents import Document, Citation, section_map
+from utils.connect_oceanbse import connect_oceanbase, vector_search_params
 from agent.prompt import RAG_PROMPT, SECTION_PROMPT, INTENT_PROMPT
 from agent.base_agent import Agent
+from agent.history import SUMMARY_PREFIX, HistoryManager, recent_messages
 
 
 def doc_search_by_vector(vector: list[float], partition_names=None, limit: int = 10,) -> list[Document]:
-    oceanbase = connect_oceanbase()
+    cache = get_retrieval_cache()
+    key = cache.key(vector, partition_names, limit)
+    docs = cache.get(key)
+    if docs is not None:
+        return docs
 
-    docs = oceanbase.similarity_search_by_vector(
+    store = get_local_store() if os.getenv("VECTOR_BACKEND", "oceanbase") == "local" else connect_oceanbase()
+
+    search_start = time.perf_counter()
+    docs = store.similarity_search_by_vector(
         embedding=vector,
         k=limit,
         partition_names=partition_names,
+        param=vector_search_params(),
     )
+    cache.put(key, docs, time.perf_counter() - search_start)
     return docs
 
 
+def format_snippets(docs: list[Document]) -> str:
+    """Document snippets for RAG_PROMPT, the model cites them as [@1], [@2], ..."""
+    return "\n=====\n".join(["文档片段:\n\n" + chunk.page_content for chunk in docs])
+
+
+def link_citations(text: str, citations: list[Citation], visited: dict, references: list[str]) -> str:
+    """Replace the [@n] markers in the text by numbered links.
+
+    Args:
+        text: Answer text.
+        citations: Citations of the documents given to the model, in snippet order.
+        visited: Url to reference number of the documents cited so far, updated in place.
+        references: Reference list lines, newly cited documents are appended in place.
+
+    Returns:
+        The text with linked references.
+    """
+    matches = re.findall(r"(\[+\@(\d+)\]+)", text)
+    # [('[@1]', '1'), ('[@23]', '23')]
+    for m, order in matches:
+        if not 0 < int(order) <= len(citations):
+            continue
+        citation = citations[int(order) - 1]
+        if citation.url not in visited:
+            visited[citation.url] = len(visited) + 1
+            references.append(f"{visited[citation.url]}. [{citation.title}]({citation.url})")
+        text = text.replace(m, f"[[{visited[citation.url]}]]({citation.url})")
+    return text
+
+
 def doc_rag_stream(
+    query: str,
+    chat_history: list[dict],
+    llm_model: str,
+    **kwargs,
+) -> Iterator[Union[str, AIMessageChunk]]:
+    """
+    Answer a question with retrieved documents, streaming progress messages,
+    a None marker before the first answer token and then the answer chunks.
+    Answer tokens are coalesced into larger chunks, see coalesce_chunks.
+
+    Identical questions in flight at the same time share one execution, see SingleFlight.
+    """
+    def run():
+        return coalesce_chunks(_doc_rag_stream(query, chat_history, llm_model, **kwargs))
+
+    flights = get_single_flight()
+    if flights is None:
+        return run()
+    return flights.stream(flights.key(query, chat_history, llm_model=llm_model, **kwargs), run)
+
+
+def _doc_rag_stream(
     query: str,
     chat_history: list[dict],
     llm_model: str,
     universal_rag: bool = False,
     search_docs: bool = True,
+    rag_history_budget: int = int(os.getenv("RAG_HISTORY_TOKEN_BUDGET", 3000)),
+    section_history_budget: int = int(os.getenv("SECTION_HISTORY_TOKEN_BUDGET", 500)),
     **kwargs,
 ) -> Iterator[Union[str, AIMessageChunk]]:
     start_time = time.time()
@@ -40,7 +110,13 @@ def doc_rag_stream(
     section_agent = Agent(prompt=SECTION_PROMPT, llm_model=llm_model)
     embedding = get_embedding()
 
-    query_with_history = "\n".join([msg["content"] for msg in chat_history if msg["role"] == "user"])
+    chat_history = HistoryManager(rag_history_budget, llm_model=llm_model).compact(chat_history)
+    # Section analysis sees the summary and the user messages of the same compacted history, no second summary.
+    section_history = recent_messages(
+        [msg for msg in chat_history if msg["role"] == "user" or msg["content"].startswith(SUMMARY_PREFIX)],
+        section_history_budget,
+    )
+    query_with_history = "\n".join([msg["content"] for msg in section_history])
     query_with_history += "\n" + query
 
     def message_with_time(text):
@@ -67,8 +143,18 @@ def doc_rag_stream(
     else:
         yield "正在分析问题的意图..."
 
-        intent = intent_agent.invoke_json(query)
-        intent_type = intent.get("type", "Algorithm")
+        query_embedded = None
+        prediction = {}
+        classifier = get_classifier()
+        if classifier is not None:
+            query_embedded = embedding.embed_query(query)
+            prediction = classifier.predict(query_embedded)
+
+        if prediction.get("intent_confidence", 0) >= getattr(classifier, "min_confidence", 1):
+            intent_type = prediction["type"]
+        else:
+            intent = intent_agent.invoke_json(query, keys=["type"])
+            intent_type = intent.get("type", "Algorithm")
 
         if intent_type == "Chat":
             yield message_with_time("没有算法相关内容")
@@ -76,15 +162,19 @@ def doc_rag_stream(
             yield from rag_agent.stream(query, chat_history, document_snippets="")
             return
 
-        section = section_agent.invoke_json(query_with_history)
-        sections: list[str] = section.get("components", ["Basic"])
+        if prediction.get("section_confidence", 0) >= getattr(classifier, "min_confidence", 1):
+            sections: list[str] = prediction["components"]
+        else:
+            section = section_agent.invoke_json(query_with_history, keys=["components"])
+            sections: list[str] = section.get("components", ["Basic"])
 
         sections = list(set(sec for sec in sections if sec in all_sections))
 
         yield "列出相关板块" + ", ".join(sections)
 
-        yield message_with_time("正在使用深度学习模型将提问内容嵌入为向量...")
-        query_embedded = embedding.embed_query(query)
+        if query_embedded is None:
+            yield message_with_time("正在使用深度学习模型将提问内容嵌入为向量...")
+            query_embedded = embedding.embed_query(query)
 
         total_docs = []
         for sec in sections:
@@ -95,44 +185,17 @@ def doc_rag_stream(
 
     yield message_with_time("大语言模型正在思考...")
 
-    docs_content = "\n=====\n".join(
-        [f"文档片段:\n\n" + chunk.page_content for i, chunk in enumerate(docs)]
-    )
-
-    ans_itr = rag_agent.stream(query, chat_history, document_snippets=docs_content)
+    ans_itr = rag_agent.stream(query, chat_history, document_snippets=format_snippets(docs))
+    citations = [Citation.from_metadata(doc.metadata) for doc in docs]
 
     visited = {}
-    count = 0
     buffer: str = ""
     pruned_references = []
     get_first_token = False
     for chunk in ans_itr:
         buffer += chunk.content
         if "[" in buffer and len(buffer) < 128:
-            matches = re.findall(r"(\[+\@(\d+)\]+)", buffer)
-            # [('[@1]', '1'), ('[@23]', '23')]
-            if matches:
-                sorted(matches, key=lambda x: x[0], reverse=True)
-
-                for m, order in matches:
-                    doc = docs[int(order) - 1]
-                    meta = DocumentMeta.model_validate(doc.metadata)
-
-                    doc_name = meta.doc_name
-                    doc_url = meta.doc_url.replace("doc\\docs", "https://oi-wiki.org/")\
-                                          .replace("\\", "/")\
-                                          .replace(".md", "")
-                    idx = count + 1
-                    if doc_url in visited:
-                        idx = visited[doc_url]
-                    else:
-                        visited[doc_url] = idx
-                        doc_text = f"{idx}. [{doc_name}]({doc_url})"
-                        pruned_references.append(doc_text)
-                        count += 1
-
-                    ref_text = f"[[{idx}]]({doc_url})"
-                    buffer = buffer.replace(m, ref_text)
+            buffer = link_citations(buffer, citations, visited, pruned_references)
 
         if not get_first_token:
             get_first_token = True
@@ -152,19 +215,12 @@ def doc_rag_stream(
         for ref in pruned_references:
             yield AIMessageChunk(content="\n" + ref)
 
-    elif len(docs) > 0:
+    elif len(citations) > 0:
         yield AIMessageChunk(content="\n\n" + ref_tip)
 
         visited = {}
-        for doc in docs:
-            meta = DocumentMeta.model_validate(doc.metadata)
-            doc_name = meta.doc_name
-            doc_url = meta.doc_url.replace("doc\\docs", "https://oi-wiki.org/") \
-                .replace("\\", "/") \
-                .replace(".md", "")
-            if doc_url in visited:
+        for citation in citations:
+            if citation.url in visited:
                 continue
-            visited[doc_url] = True
-            count = len(visited)
-            doc_text = f"{count}. [{doc_name}]({doc_url})"
-            yield AIMessageChunk(content="\n" + doc_text)
+            visited[citation.url] = True
+            yield AIMessageChunk(content=f"\n{len(visited)}. [{citation.title}]({citation.url})")
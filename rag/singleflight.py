@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import json
+import hashlib
+import threading
+import contextvars
+import unicodedata
+from typing import Callable, Iterator
+
+__single_flight = None
+__single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Process-wide SingleFlight, or None if SINGLE_FLIGHT is disabled."""
+    global __single_flight
+    if os.getenv("SINGLE_FLIGHT", "true").lower() not in ("1", "true", "yes"):
+        return None
+    with __single_flight_lock:
+        if __single_flight is None:
+            __single_flight = SingleFlight()
+        return __single_flight
+
+
+def normalize_query(text: str) -> str:
+    """Fold width, case and whitespace differences and trailing punctuation, e.g. "逆元怎么计算？ " -> "逆元怎么计算"."""
+    text = " ".join(unicodedata.normalize("NFKC", text).split()).lower()
+    return text.rstrip("?!.。 ")
+
+
+class Broadcast:
+    """
+    Fan-out of one stream to any number of subscribers.
+
+    Every published item is kept until the stream ends, so a subscriber that
+    joins late first replays the prefix it missed.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.__cond = threading.Condition()
+
+    def publish(self, item):
+        with self.__cond:
+            self.items.append(item)
+            self.__cond.notify_all()
+
+    def finish(self, error: Exception = None):
+        with self.__cond:
+            self.done = True
+            self.error = error
+            self.__cond.notify_all()
+
+    def get(self, index: int):
+        """The item at the index, waiting for it to be published. Raises StopIteration at the end of the stream."""
+        with self.__cond:
+            while index >= len(self.items) and not self.done:
+                self.__cond.wait()
+            if index < len(self.items):
+                return self.items[index]
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+
+
+class Subscription:
+    """Iterator over a broadcast, detaches from it when exhausted, closed or garbage collected."""
+
+    def __init__(self, broadcast: Broadcast, on_close: Callable[[Broadcast], None]):
+        self.__broadcast = broadcast
+        self.__on_close = on_close
+        self.__index = 0
+        self.__closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            item = self.__broadcast.get(self.__index)
+        except BaseException:
+            self.close()
+            raise
+        self.__index += 1
+        return item
+
+    def close(self):
+        if not self.__closed:
+            self.__closed = True
+            self.__on_close(self.__broadcast)
+
+    def __del__(self):
+        self.close()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests into one execution.
+
+    The first request of a key becomes the leader: its stream runs in a
+    background thread and publishes into a Broadcast. Requests with the same
+    key that arrive while it runs subscribe to that broadcast instead of
+    running the pipeline again. Once every subscriber has gone, the execution
+    is abandoned and its stream closed. A request arriving after the execution
+    has ended starts a new one, nothing is cached.
+    """
+
+    def __init__(self):
+        self.__flights: dict[str, Broadcast] = {}
+        self.__lock = threading.Lock()
+        self.__executions = 0
+        self.__joined = 0
+
+    @staticmethod
+    def key(query: str, chat_history: list[dict], **kwargs) -> str:
+        """Requests share a key if their normalized query, history and other arguments are equal."""
+        payload = json.dumps(
+            {
+                "query": normalize_query(query),
+                "history": [(msg["role"], normalize_query(msg["content"])) for msg in chat_history],
+                "kwargs": kwargs,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _release(self, broadcast: Broadcast):
+        with self.__lock:
+            broadcast.subscribers -= 1
+
+    def stream(self, key: str, factory: Callable[[], Iterator]) -> Subscription:
+        """Subscribe to the execution of the key, starting `factory()` if none is in flight."""
+        with self.__lock:
+            broadcast = self.__flights.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = Broadcast()
+                self.__flights[key] = broadcast
+                self.__executions += 1
+            else:
+                self.__joined += 1
+            broadcast.subscribers += 1
+            subscription = Subscription(broadcast, self._release)
+
+        if leader:
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._run, key, broadcast, factory), daemon=True).start()
+        return subscription
+
+    def _run(self, key: str, broadcast: Broadcast, factory: Callable[[], Iterator]):
+        error = None
+        stream = None
+        try:
+            stream = factory()
+            for item in stream:
+                broadcast.publish(item)
+                with self.__lock:
+                    if broadcast.subscribers <= 0:
+                        # Everyone left, detach the key first so that nobody joins a dead execution.
+                        self.__flights.pop(key, None)
+                        break
+        except Exception as e:
+            error = e
+        finally:
+            with self.__lock:
+                if self.__flights.get(key) is broadcast:
+                    del self.__flights[key]
+            if stream is not None and hasattr(stream, "close"):
+                stream.close()
+            broadcast.finish(error)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "in_flight": len(self.__flights),
+                "executions": self.__executions,
+                "joined": self.__joined,
+            }
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import argparse
+import threading
+import datetime
+from typing import Iterator
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from rag.documents import Document, section_map
+from rag.local_index import FlatIndex, TwoStageIndex, truncate_normalize
+
+SNAPSHOT_VERSION = 1
+
+__local_store = None
+__local_store_lock = threading.Lock()
+
+# Files of a snapshot directory. Vectors and section codes are raw little-endian
+# column blocks that np.memmap maps directly, records.jsonl holds one
+# {"id", "document", "metadata"} line per row and offsets.i64 the byte offset of
+# every line, so that single records can be read without loading the file.
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.f32"
+SECTION_CODES_FILE = "section_codes.i16"
+RECORDS_FILE = "records.jsonl"
+OFFSETS_FILE = "offsets.i64"
+
+
+class SnapshotWriter:
+    """
+    Append-only writer of a corpus snapshot, rows are streamed to disk as they come.
+    """
+
+    def __init__(self, path: str, **manifest):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.manifest = {"version": SNAPSHOT_VERSION, **manifest}
+        self.count = 0
+        self.dimension = None
+        self.__vectors = open(os.path.join(path, VECTORS_FILE), "wb")
+        self.__codes = open(os.path.join(path, SECTION_CODES_FILE), "wb")
+        self.__records = open(os.path.join(path, RECORDS_FILE), "wb")
+        self.__offsets = open(os.path.join(path, OFFSETS_FILE), "wb")
+
+    def write(self, row_id: str, document: str, metadata: dict, section_code: int, vector: list[float]):
+        vector = np.asarray(vector, dtype="<f4")
+        if self.dimension is None:
+            self.dimension = len(vector)
+        elif len(vector) != self.dimension:
+            raise ValueError(f"vector of {row_id} has dimension {len(vector)}, expected {self.dimension}.")
+
+        self.__offsets.write(np.asarray([self.__records.tell()], dtype="<i8").tobytes())
+        line = json.dumps({"id": row_id, "document": document, "metadata": metadata}, ensure_ascii=False)
+        self.__records.write(line.encode("utf-8") + b"\n")
+        self.__vectors.write(vector.tobytes())
+        self.__codes.write(np.asarray([section_code], dtype="<i2").tobytes())
+        self.count += 1
+
+    def close(self):
+        for f in (self.__vectors, self.__codes, self.__records, self.__offsets):
+            f.close()
+        self.manifest.update({
+            "count": self.count,
+            "dimension": self.dimension or 0,
+            "created": str(datetime.datetime.now()),
+        })
+        with open(os.path.join(self.path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Snapshot:
+    """
+    Read-only view of a corpus snapshot, the column blocks are memory-mapped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {self.manifest.get('version')}.")
+        self.count = self.manifest["count"]
+        self.dimension = self.manifest["dimension"]
+        self.vectors = self._map(VECTORS_FILE, "<f4", (self.count, self.dimension))
+        self.section_codes = self._map(SECTION_CODES_FILE, "<i2", (self.count,))
+        self.offsets = self._map(OFFSETS_FILE, "<i8", (self.count,))
+        self.__records = open(os.path.join(path, RECORDS_FILE), "rb")
+        self.__records_lock = threading.Lock()
+
+    def _map(self, name: str, dtype: str, shape: tuple) -> np.ndarray:
+        if self.count == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=shape)
+
+    def coarse_vectors(self, dim: int) -> np.ndarray:
+        """Truncated, renormalized copy of the vectors, written next to the full block on first use."""
+        name = f"vectors_{dim}.f32"
+        if not os.path.exists(os.path.join(self.path, name)):
+            truncate_normalize(self.vectors, dim).astype("<f4").tofile(os.path.join(self.path, name))
+        return np.asarray(self._map(name, "<f4", (self.count, dim)))
+
+    def record(self, index: int) -> dict:
+        with self.__records_lock:
+            self.__records.seek(int(self.offsets[index]))
+            line = self.__records.readline()
+        return json.loads(line)
+
+    def document(self, index: int) -> Document:
+        record = self.record(index)
+        return Document(record["document"], metadata=record["metadata"])
+
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[tuple[list[dict], np.ndarray, np.ndarray]]:
+        """Stream (records, vectors, section codes) batches in row order with constant memory."""
+        with open(os.path.join(self.path, RECORDS_FILE), "rb") as f:
+            for start in range(0, self.count, batch_size):
+                stop = min(start + batch_size, self.count)
+                records = [json.loads(f.readline()) for _ in range(start, stop)]
+                yield records, np.asarray(self.vectors[start:stop]), np.asarray(self.section_codes[start:stop])
+
+
+def get_local_store():
+    global __local_store
+    with __local_store_lock:
+        if __local_store is None:
+            path = os.getenv("SNAPSHOT_PATH", "snapshot")
+            print(f"Using LocalVectorStore from {path}")
+            __local_store = LocalVectorStore(
+                Snapshot(path),
+                metric=os.getenv("OB_VECTOR_METRIC", "l2"),
+                coarse_dim=int(os.getenv("COARSE_DIM", 0)),
+                shortlist=int(os.getenv("RESCORE_SHORTLIST", 100)),
+            )
+        return __local_store
+
+
+class LocalVectorStore:
+    """
+    In-process vector store over a snapshot, searched like OceanbaseVectorStore.
+
+    With a coarse_dim the search runs in two stages on a low-dimensional copy of
+    the vectors, see TwoStageIndex.
+    """
+
+    def __init__(self, snapshot: Snapshot, metric: str = "l2", coarse_dim: int = 0, shortlist: int = 100):
+        self.snapshot = snapshot
+        if 0 < coarse_dim < snapshot.dimension:
+            self.index = TwoStageIndex(
+                snapshot.vectors, snapshot.coarse_vectors(coarse_dim), shortlist=shortlist, metric=metric
+            )
+        else:
+            self.index = FlatIndex(snapshot.vectors, metric)
+        self.__partition_rows = {}
+
+    def _partition_rows(self, partition_names: list[str]) -> np.ndarray:
+        key = tuple(sorted(partition_names))
+        if key not in self.__partition_rows:
+            codes = [section_map[name] for name in key if name in section_map]
+            self.__partition_rows[key] = np.flatnonzero(np.isin(self.snapshot.section_codes, codes))
+        return self.__partition_rows[key]
+
+    def similarity_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 10,
+            partition_names: list[str] = None,
+            **kwargs,
+    ) -> list[Document]:
+        candidates = self._partition_rows(partition_names) if partition_names else None
+        rows = self.index.search(np.asarray(embedding, dtype=np.float32), k, candidates)
+        return [self.snapshot.document(int(i)) for i in rows]
+
+
+class QueuedEmbedding(Embeddings):
+    """Embedding function that hands out precomputed vectors in the order the texts are embedded."""
+
+    def __init__(self):
+        self.pending: list[list[float]] = []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if len(texts) > len(self.pending):
+            raise ValueError(f"{len(texts)} texts to embed but only {len(self.pending)} vectors queued.")
+        vectors, self.pending = self.pending[: len(texts)], self.pending[len(texts):]
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def export_snapshot(path: str, batch_size: int = 1000, partition_names: list[str] = None):
+    """Export the corpus table into a snapshot directory."""
+    from utils.connect_oceanbse import iter_corpus
+
+    start = time.time()
+    with SnapshotWriter(path, table_name=os.getenv("TABLE_NAME", "corpus")) as writer:
+        for row in iter_corpus(batch_size, partition_names, with_vectors=True, with_content=True):
+            writer.write(row["id"], row["document"], row["metadata"], row["section_code"], row["embedding"])
+            if writer.count % (batch_size * 10) == 0:
+                print(f"{writer.count} rows exported")
+    print(f"Exported {writer.count} rows to {path} in {time.time() - start:.1f}s")
+
+
+def import_snapshot(path: str, batch_size: int = 1000, table_name: str = None):
+    """Bulk-insert a snapshot into the OceanBase corpus table without re-embedding."""
+    from rag.cache import get_retrieval_cache
+    from utils.connect_oceanbse import create_store
+
+    snapshot = Snapshot(path)
+    embedding = QueuedEmbedding()
+    store = create_store(embedding, **({"table_name": table_name} if table_name else {}))
+    code_to_section = {code: name for name, code in section_map.items()}
+
+    start = time.time()
+    imported = 0
+    for records, vectors, codes in snapshot.iter_batches(batch_size):
+        for code in np.unique(codes):
+            rows = np.flatnonzero(codes == code)
+            embedding.pending = vectors[rows].tolist()
+            # add_texts prints and skips a failed insert, only the ids it returns were written.
+            imported += len(store.add_texts(
+                [records[i]["document"] for i in rows],
+                metadatas=[records[i]["metadata"] for i in rows],
+                ids=[records[i]["id"] for i in rows],
+                extras=[{"section_code": int(code)} for _ in rows],
+                partition_name=code_to_section.get(int(code), ""),
+            ) or [])
+        print(f"{imported}/{snapshot.count} rows imported")
+    get_retrieval_cache().invalidate()
+    print(f"Imported {imported} rows from {path} in {time.time() - start:.1f}s")
+    if imported < snapshot.count:
+        print(f"{snapshot.count - imported} rows failed to import, see the errors above.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or import a corpus snapshot.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="export the corpus table into a snapshot")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--sections", nargs="*", help="only export these sections")
+    import_parser = subparsers.add_parser("import", help="bulk-insert a snapshot into the corpus table")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--table-name")
+    for p in (export_parser, import_parser):
+        p.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_snapshot(args.path, args.batch_size, args.sections)
+    else:
+        import_snapshot(args.path, args.batch_size, args.table_name)
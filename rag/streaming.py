@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import time
+import queue
+import threading
+import contextvars
+from typing import Iterator, Union
+
+from langchain_core.messages import AIMessageChunk
+
+_END = object()
+
+
+def _read_ahead(chunks: Iterator, items: queue.Queue, stop: threading.Event):
+    """Move the chunks into the queue, ends with _END or the exception raised by the stream."""
+    try:
+        for chunk in chunks:
+            items.put(chunk)
+            if stop.is_set():
+                break
+        items.put(_END)
+    except BaseException as e:
+        items.put(e)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def coalesce_chunks(
+        chunks: Iterator[Union[str, None, AIMessageChunk]],
+        interval: float = float(os.getenv("STREAM_FLUSH_INTERVAL", 0.05)),
+        max_chars: int = int(os.getenv("STREAM_FLUSH_CHARS", 64)),
+) -> Iterator[Union[str, None, AIMessageChunk]]:
+    """Merge consecutive answer chunks into larger ones.
+
+    The buffered text is flushed once `interval` seconds have passed since the
+    last flush or `max_chars` characters are buffered. The stream is read in a
+    background thread, so the interval also holds while the upstream stalls.
+    The first non-empty answer chunk is flushed immediately so the time to
+    first token is unchanged, empty chunks are dropped. Progress messages and
+    None markers are passed through, after flushing the buffer.
+
+    Args:
+        chunks: Output of doc_rag_stream.
+        interval: Maximum time between two flushes, in seconds.
+        max_chars: Maximum number of buffered characters.
+
+    Returns:
+        The same stream with fewer, larger AIMessageChunks.
+    """
+    items = queue.Queue()
+    stop = threading.Event()
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(_read_ahead, chunks, items, stop), daemon=True).start()
+
+    parts: list[str] = []
+    size = 0
+    first = True
+    last_flush = time.monotonic()
+
+    try:
+        while True:
+            timeout = max(0.0, last_flush + interval - time.monotonic()) if parts else None
+            try:
+                chunk = items.get(timeout=timeout)
+            except queue.Empty:
+                yield AIMessageChunk(content="".join(parts))
+                parts, size, last_flush = [], 0, time.monotonic()
+                continue
+
+            if chunk is _END:
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not isinstance(chunk, AIMessageChunk):
+                if parts:
+                    yield AIMessageChunk(content="".join(parts))
+                    parts, size, last_flush = [], 0, time.monotonic()
+                yield chunk
+                continue
+            if not chunk.content:
+                continue
+
+            parts.append(chunk.content)
+            size += len(chunk.content)
+            if first or size >= max_chars or time.monotonic() - last_flush >= interval:
+                yield AIMessageChunk(content="".join(parts))
+                parts, size, first, last_flush = [], 0, False, time.monotonic()
+
+        if parts:
+            yield AIMessageChunk(content="".join(parts))
+    finally:
+        # The reader stops after its next chunk when the consumer leaves early.
+        stop.set()
@@ -1,7 +1,14 @@
 import os
+import json
+import weakref
+import threading
 import dotenv
+
+from typing import Iterator, Optional
 from rag.embeddings import get_embedding
-from sqlalchemy import Column, Integer
+from utils.db_pool import pool_args, pool_status, prewarm
+from sqlalchemy import Column, Integer, event
+from langchain_core.embeddings import Embeddings
 from langchain_oceanbase.vectorstores import OceanbaseVectorStore
 from rag.documents import MarkdownDocumentsLoader, section_map as cm
 from pyobvector import ObListPartition, RangeListPartInfo
@@ -17,24 +24,143 @@ connection_args = {
 }
 
 instance = None
+instance_lock = threading.Lock()
+# Engines whose new connections set the efSearch of their store.
+_ef_search_engines = weakref.WeakSet()
+
+
+def vector_index_args(index_params: Optional[dict] = None, metric: Optional[str] = None) -> dict:
+    """Vector index arguments of OceanbaseVectorStore, defaulting to the OB_VECTOR_* environment variables.
+
+    langchain-oceanbase 0.2.0 always builds an HNSW index, so only its metric
+    and build parameters (M, efConstruction) are configurable.
+    """
+    return {
+        "vidx_metric_type": metric or os.getenv("OB_VECTOR_METRIC", "l2"),
+        "vidx_algo_params": index_params or json.loads(os.getenv("OB_VECTOR_INDEX_PARAMS") or "null"),
+    }
+
+
+def vector_search_params() -> Optional[dict]:
+    """Search-time parameters of the vector index, e.g. {"efSearch": 64}."""
+    return json.loads(os.getenv("OB_VECTOR_SEARCH_PARAMS") or "null")
+
+
+def apply_search_params(store: OceanbaseVectorStore, params: Optional[dict]):
+    """Set the efSearch of the params on every connection of the store.
+
+    langchain-oceanbase sets it with `SET @@ob_hnsw_ef_search` on whichever
+    pooled connection it checks out and then remembers the value, so the other
+    connections of the pool would keep the default. Instead every new
+    connection runs the SET, and the pooled connections are replaced.
+    """
+    ef_search = (params or {}).get("efSearch")
+    if ef_search is None or ef_search == getattr(store, "hnsw_ef_search", None):
+        return
+    store.hnsw_ef_search = ef_search
+    engine = store.obvector.engine
+    if engine not in _ef_search_engines:
+        _ef_search_engines.add(engine)
+
+        @event.listens_for(engine, "connect")
+        def set_ef_search(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET @@ob_hnsw_ef_search = {int(store.hnsw_ef_search)}")
+            cursor.close()
+    engine.dispose()
+
+
+def create_store(embedding_function: Embeddings = None, **kwargs) -> OceanbaseVectorStore:
+    """Create a store on the section-partitioned corpus table, keyword arguments override the defaults."""
+    args = {
+        "table_name": os.getenv("TABLE_NAME", "corpus"),
+        "connection_args": connection_args,
+        "metadata_field": "metadata",
+        "extra_columns": [Column("section_code", Integer, primary_key=True)],
+        "partitions": ObListPartition(
+            is_list_columns=False,
+            list_part_infos=[RangeListPartInfo(k, v) for k, v in cm.items()]
+                            + [RangeListPartInfo("p10", "DEFAULT")],
+            list_expr="section_code",
+        ),
+        **vector_index_args(),
+        **pool_args(),
+    }
+    args.update(kwargs)
+    store = OceanbaseVectorStore(embedding_function=embedding_function or get_embedding(), **args)
+    apply_search_params(store, vector_search_params())
+    return store
 
 
 def connect_oceanbase() -> OceanbaseVectorStore:
     global instance
-    if instance is None:
-        instance = OceanbaseVectorStore(
-            embedding_function=get_embedding(),
-            table_name=os.getenv("TABLE_NAME", "corpus"),
-            connection_args=connection_args,
-            metadata_field="metadata",
-            extra_columns=[Column("section_code", Integer, primary_key=True)],
-            partitions=ObListPartition(
-                is_list_columns=False,
-                list_part_infos=[RangeListPartInfo(k, v) for k, v in cm.items()]
-                                + [RangeListPartInfo("p10", "DEFAULT")],
-                list_expr="section_code",
-            )
-        )
+    if instance is not None:
+        return instance
+    with instance_lock:
+        if instance is None:
+            store = create_store()
+            prewarm_count = int(os.getenv("DB_POOL_PREWARM", 2))
+            if prewarm_count > 0:
+                try:
+                    prewarm(store.obvector.engine, prewarm_count)
+                except Exception as e:
+                    print("Failed to prewarm the OceanBase connection pool:", e)
+            instance = store
     return instance
 
 
+def connection_pool_status() -> dict:
+    return pool_status(connect_oceanbase().obvector.engine)
+
+
+def iter_corpus(
+        batch_size: int = 1000,
+        partition_names: list[str] = None,
+        with_vectors: bool = True,
+        with_content: bool = False,
+) -> Iterator[dict]:
+    """Stream the rows of the corpus table in primary key order.
+
+    Args:
+        batch_size: Number of rows fetched per query.
+        partition_names: Only read the rows of these sections.
+        with_vectors: Also return the stored embedding of each row.
+        with_content: Also return the document text and metadata of each row.
+
+    Returns:
+        Iterator of dicts with the keys id, section_code and, if requested,
+        embedding, document and metadata.
+    """
+    ob = connect_oceanbase()
+    columns = [ob.primary_field, "section_code"]
+    if with_vectors:
+        columns.append(ob.vector_field)
+    if with_content:
+        columns.extend([ob.text_field, ob.metadata_field])
+
+    where = ""
+    if partition_names:
+        codes = ", ".join(str(cm[name]) for name in partition_names)
+        where = f"section_code IN ({codes}) AND "
+
+    last_id = ""
+    while True:
+        rows = list(ob.obvector.perform_raw_text_sql(
+            f"SELECT {', '.join(columns)} FROM {ob.table_name} "
+            f"WHERE {where}{ob.primary_field} > '{last_id}' "
+            f"ORDER BY {ob.primary_field} LIMIT {batch_size}"
+        ))
+        for row in rows:
+            item = {"id": row[0], "section_code": int(row[1])}
+            rest = list(row[2:])
+            if with_vectors:
+                vector = rest.pop(0)
+                item["embedding"] = json.loads(vector) if isinstance(vector, str) else list(vector)
+            if with_content:
+                metadata = rest.pop(1)
+                item["document"] = rest[0]
+                item["metadata"] = json.loads(metadata) if isinstance(metadata, str) else metadata
+            yield item
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
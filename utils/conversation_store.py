@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from typing import Optional
+
+__conversation_store = None
+__conversation_store_lock = threading.Lock()
+
+
+def get_conversation_store():
+    global __conversation_store
+    with __conversation_store_lock:
+        if __conversation_store is None:
+            __conversation_store = ConversationStore(
+                path=os.getenv("CONVERSATION_DB", "data/conversations.db"),
+                window=int(os.getenv("CONVERSATION_WINDOW", 50)),
+                idle_ttl=float(os.getenv("CONVERSATION_IDLE_TTL", 1800)),
+                max_sessions=int(os.getenv("CONVERSATION_MAX_SESSIONS", 1000)),
+            )
+        return __conversation_store
+
+
+class _Session:
+    __slots__ = ("messages", "count", "last_access")
+
+    def __init__(self, messages: list[dict], count: int, window: int):
+        self.messages = deque(messages, maxlen=window)
+        self.count = count
+        self.last_access = time.monotonic()
+
+
+class ConversationStore:
+    """
+    Chat messages persisted in SQLite with a bounded in-memory window per session.
+
+    Only the last `window` messages of a session are kept in memory, older ones
+    are read from the database on demand. Sessions idle for `idle_ttl` seconds,
+    or beyond `max_sessions`, are evicted from memory and reloaded from the
+    database when they come back.
+    """
+
+    def __init__(self, path: str = "data/conversations.db", window: int = 50, idle_ttl: float = 1800, max_sessions: int = 1000):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.window = window
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+            "role TEXT NOT NULL, content TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)")
+        self.__conn.commit()
+        self.__sessions: OrderedDict[str, _Session] = OrderedDict()
+        self.__lock = threading.RLock()
+        self.__last_eviction = time.monotonic()
+
+    def _query(self, sql: str, params: tuple) -> list[dict]:
+        rows = self.__conn.execute(sql, params).fetchall()
+        return [{"id": row[0], "role": row[1], "content": row[2]} for row in rows]
+
+    def _session(self, session_id: str) -> _Session:
+        """The in-memory window of a session, loaded from the database on first access."""
+        session = self.__sessions.get(session_id)
+        if session is None:
+            count = self.__conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            messages = self._query(
+                "SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, self.window),
+            )
+            session = _Session(messages[::-1], count, self.window)
+            self.__sessions[session_id] = session
+        self.__sessions.move_to_end(session_id)
+        session.last_access = time.monotonic()
+        self._evict()
+        return session
+
+    def _evict(self):
+        now = time.monotonic()
+        while len(self.__sessions) > self.max_sessions:
+            self.__sessions.popitem(last=False)
+        if now - self.__last_eviction < min(self.idle_ttl, 60):
+            return
+        self.__last_eviction = now
+        for session_id in [sid for sid, s in self.__sessions.items() if now - s.last_access > self.idle_ttl]:
+            del self.__sessions[session_id]
+
+    def append(self, session_id: str, role: str, content: str):
+        with self.__lock:
+            session = self._session(session_id)
+            cursor = self.__conn.execute(
+                "INSERT INTO messages (session_id, role, content, created) VALUES (?, ?, ?, ?)",
+                (session_id, role, content, time.time()),
+            )
+            self.__conn.commit()
+            session.messages.append({"id": cursor.lastrowid, "role": role, "content": content})
+            session.count += 1
+
+    def count(self, session_id: str) -> int:
+        with self.__lock:
+            return self._session(session_id).count
+
+    def recent(self, session_id: str, limit: int) -> list[dict]:
+        """The last `limit` messages of a session, oldest first."""
+        if limit <= 0:
+            return []
+        with self.__lock:
+            session = self._session(session_id)
+            if limit <= len(session.messages) or len(session.messages) == session.count:
+                return list(session.messages)[-limit:]
+            return self._query(
+                "SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit),
+            )[::-1]
+
+    def recent_turns(self, session_id: str, turns: int) -> list[dict]:
+        """The messages of the last `turns` turns, a turn starts at a user message."""
+        if turns <= 0:
+            return []
+        with self.__lock:
+            session = self._session(session_id)
+            seen = 0
+            for i in range(len(session.messages) - 1, -1, -1):
+                if session.messages[i]["role"] == "user":
+                    seen += 1
+                    if seen == turns:
+                        return list(session.messages)[i:]
+            if len(session.messages) == session.count:
+                return list(session.messages)
+
+            row = self.__conn.execute(
+                "SELECT id FROM messages WHERE session_id = ? AND role = 'user' ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (session_id, turns - 1),
+            ).fetchone()
+            return self._query(
+                "SELECT id, role, content FROM messages WHERE session_id = ? AND id >= ? ORDER BY id",
+                (session_id, row[0] if row else 0),
+            )
+
+    def page(self, session_id: str, before_id: Optional[int] = None, limit: int = 20) -> list[dict]:
+        """Up to `limit` messages older than `before_id`, oldest first, for paginated rendering."""
+        with self.__lock:
+            return self._query(
+                "SELECT id, role, content FROM messages WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before_id if before_id is not None else 2 ** 63 - 1, limit),
+            )[::-1]
+
+    def clear(self, session_id: str):
+        with self.__lock:
+            self.__conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.__conn.commit()
+            self.__sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "sessions_in_memory": len(self.__sessions),
+                "messages_in_memory": sum(len(s.messages) for s in self.__sessions.values()),
+            }
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import time
+import threading
+from collections import deque
+
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+def pool_args() -> dict:
+    """SQLAlchemy pool settings read from the environment."""
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 3600)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+        "poolclass": MeteredQueuePool,
+    }
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited for a connection.
+    """
+
+    def _metrics(self):
+        metrics = getattr(self, "_checkout_metrics", None)
+        if metrics is None:
+            metrics = self._checkout_metrics = {
+                "lock": threading.Lock(),
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "timeouts": 0,
+                "recent": deque(maxlen=1000),
+            }
+        return metrics
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            metrics = self._metrics()
+            with metrics["lock"]:
+                metrics["count"] += 1
+                metrics["total"] += wait
+                metrics["max"] = max(metrics["max"], wait)
+                metrics["timeouts"] += timed_out
+                metrics["recent"].append(wait)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool._checkout_metrics = self._metrics()
+        return pool
+
+
+def create_pooled_engine(url: str, **kwargs) -> Engine:
+    """Create an engine with the configured pool, e.g. against a local sqlite file for testing."""
+    return create_engine(url, **{**pool_args(), **kwargs})
+
+
+def prewarm(engine: Engine, connections: int):
+    """Open the given number of connections at once so that they are pooled before the first query."""
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = engine.connect()
+            conn.execute(text("SELECT 1"))
+            opened.append(conn)
+    finally:
+        for conn in opened:
+            conn.close()
+
+
+def pool_status(engine: Engine) -> dict:
+    """Utilization and checkout-wait metrics of the engine's pool."""
+    pool = engine.pool
+    status = {"pool": pool.status()}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "utilization": pool.checkedout() / capacity if capacity else 0.0,
+        })
+    if isinstance(pool, MeteredQueuePool):
+        metrics = pool._metrics()
+        with metrics["lock"]:
+            recent = sorted(metrics["recent"])
+            status.update({
+                "checkouts": metrics["count"],
+                "checkout_timeouts": metrics["timeouts"],
+                "avg_checkout_wait": metrics["total"] / metrics["count"] if metrics["count"] else 0.0,
+                "max_checkout_wait": metrics["max"],
+                "p95_checkout_wait": recent[int(len(recent) * 0.95)] if recent else 0.0,
+            })
+    return status
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+
+def default_responder(messages: list[dict]) -> str:
+    """Answer classifier prompts with a JSON verdict and everything else with filler text."""
+    system = next((m["content"] for m in messages if m["role"] == "system"), "")
+    query = messages[-1]["content"] if messages else ""
+    if '"components"' in system:
+        return json.dumps(
+            {"type": "Algorithm", "rewrite": query, "components": ["Basic", "DP"]}, ensure_ascii=False
+        )
+    return "根据文档库中的信息，" + "这是一个用于测试的回答。" * 40
+
+
+class FakeOpenAIServer:
+    """
+    Local OpenAI-compatible server for tests and load generation.
+
+    Serves /chat/completions (streaming and non-streaming) and /embeddings with
+    injectable delays: `first_token_delay` before the first token,
+    `token_delay` between tokens, per-model first-token delays, and an extra
+    `stall_delay` for the first `stall_requests` chat requests, which makes a
+    hedged retry of the same model observable.
+    """
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            first_token_delay: float = 0.0,
+            token_delay: float = 0.0,
+            model_first_token_delay: Optional[dict[str, float]] = None,
+            stall_requests: int = 0,
+            stall_delay: float = 0.0,
+            chars_per_token: int = 2,
+            responder: Callable[[list[dict]], str] = default_responder,
+    ):
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.model_first_token_delay = model_first_token_delay or {}
+        self.stall_requests = stall_requests
+        self.stall_delay = stall_delay
+        self.chars_per_token = chars_per_token
+        self.responder = responder
+        self.requests = 0
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer((host, port), self._handler())
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def serve_forever(self):
+        self.__server.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _first_token_delay(self, model: str) -> float:
+        with self.__lock:
+            self.requests += 1
+            stalled = self.requests <= self.stall_requests
+        delay = self.model_first_token_delay.get(model, self.first_token_delay)
+        return delay + (self.stall_delay if stalled else 0.0)
+
+    @staticmethod
+    def embedding(text: str, dimensions: int) -> list[float]:
+        rng = random.Random(hashlib.md5(text.encode("utf-8")).hexdigest())
+        vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+        norm = sum(v * v for v in vector) ** 0.5
+        return [v / norm for v in vector]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, data: dict):
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.rstrip("/").endswith("/embeddings"):
+                    self._embeddings(request)
+                elif self.path.rstrip("/").endswith("/chat/completions"):
+                    self._chat(request)
+                else:
+                    self.send_error(404)
+
+            def _embeddings(self, request: dict):
+                texts = request.get("input", [])
+                texts = [texts] if isinstance(texts, str) else texts
+                dimensions = request.get("dimensions", 1024)
+                self._send_json({
+                    "object": "list",
+                    "model": request.get("model", "fake"),
+                    "data": [
+                        {"object": "embedding", "index": i, "embedding": server.embedding(text, dimensions)}
+                        for i, text in enumerate(texts)
+                    ],
+                    "usage": {"prompt_tokens": sum(len(t) for t in texts), "total_tokens": sum(len(t) for t in texts)},
+                })
+
+            def _chat(self, request: dict):
+                model = request.get("model", "fake")
+                text = server.responder(request.get("messages", []))
+                n = server.chars_per_token
+                tokens = [text[i: i + n] for i in range(0, len(text), n)]
+                usage = {
+                    "prompt_tokens": sum(len(str(m.get("content", ""))) for m in request.get("messages", [])),
+                    "completion_tokens": len(tokens),
+                }
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                base = {"id": f"chatcmpl-{server.requests}", "created": int(time.time()), "model": model}
+
+                time.sleep(server._first_token_delay(model))
+                if not request.get("stream"):
+                    time.sleep(server.token_delay * len(tokens))
+                    self._send_json({
+                        **base,
+                        "object": "chat.completion",
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                        }],
+                        "usage": usage,
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+                def send(data):
+                    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+                    self.wfile.write(f"data: {payload}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                def chunk(delta, finish_reason=None):
+                    return {
+                        **base,
+                        "object": "chat.completion.chunk",
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                    }
+
+                try:
+                    send(chunk({"role": "assistant", "content": ""}))
+                    for i, token in enumerate(tokens):
+                        if i > 0:
+                            time.sleep(server.token_delay)
+                        send(chunk({"content": token}))
+                    send(chunk({}, "stop"))
+                    if request.get("stream_options", {}).get("include_usage"):
+                        send({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+                    send("[DONE]")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client cancelled the stream, e.g. the losing side of a hedged request.
+                    pass
+                self.close_connection = True
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local OpenAI-compatible server with injected delays.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first-token-delay", type=float, default=0.0)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--stall-requests", type=int, default=0)
+    parser.add_argument("--stall-delay", type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeOpenAIServer(
+        args.host, args.port, args.first_token_delay, args.token_delay,
+        stall_requests=args.stall_requests, stall_delay=args.stall_delay,
+    )
+    print(f"Fake OpenAI-compatible server listening on {fake.url}")
+    fake.serve_forever()
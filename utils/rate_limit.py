@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import enum
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+class AdmissionRejected(TimeoutError):
+    """Raised when a request waited longer than the maximum queue wait."""
+
+
+_priority = contextvars.ContextVar("request_priority", default=Priority.INTERACTIVE)
+
+__limiters = {}
+__limiters_lock = threading.Lock()
+
+
+@contextmanager
+def request_priority(priority: Priority):
+    """Run the calls made inside the block, e.g. ingestion, at the given priority."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def get_limiter(name: str) -> "TokenBucketLimiter":
+    """Process-wide limiter of a provider, configured by {NAME}_RPM and {NAME}_TPM (0 means unlimited)."""
+    with __limiters_lock:
+        if name not in __limiters:
+            prefix = name.upper()
+            __limiters[name] = TokenBucketLimiter(
+                name,
+                requests_per_minute=float(os.getenv(f"{prefix}_RPM", 0)),
+                tokens_per_minute=float(os.getenv(f"{prefix}_TPM", 0)),
+                max_queue_wait=float(os.getenv("RATE_LIMIT_MAX_QUEUE_WAIT", 30)),
+            )
+        return __limiters[name]
+
+
+class TokenBucketLimiter:
+    """
+    Requests-per-minute and tokens-per-minute token buckets with a priority queue.
+
+    Both buckets hold one minute of budget and refill continuously. Waiting
+    requests are admitted strictly in (priority, arrival) order, so interactive
+    questions overtake queued ingestion traffic. A request that cannot be
+    admitted within `max_queue_wait` fails fast with AdmissionRejected.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            requests_per_minute: float = 0,
+            tokens_per_minute: float = 0,
+            max_queue_wait: float = 30,
+    ):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue_wait = max_queue_wait
+        self.__requests = requests_per_minute
+        self.__tokens = tokens_per_minute
+        self.__updated = time.monotonic()
+        self.__cond = threading.Condition()
+        self.__waiters = []
+        self.__seq = itertools.count()
+        self.__admitted = 0
+        self.__rejected = 0
+        self.__max_depth = 0
+        self.__total_wait = 0.0
+        self.__recent_waits = deque(maxlen=1000)
+
+    @property
+    def unlimited(self) -> bool:
+        return self.requests_per_minute <= 0 and self.tokens_per_minute <= 0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.__updated
+        self.__updated = now
+        if self.requests_per_minute > 0:
+            self.__requests = min(
+                self.requests_per_minute, self.__requests + elapsed * self.requests_per_minute / 60
+            )
+        if self.tokens_per_minute > 0:
+            self.__tokens = min(self.tokens_per_minute, self.__tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _time_until_available(self, tokens: float) -> float:
+        wait = 0.0
+        if self.requests_per_minute > 0 and self.__requests < 1:
+            wait = max(wait, (1 - self.__requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute > 0 and self.__tokens < tokens:
+            wait = max(wait, (tokens - self.__tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens: float = 0, priority: Optional[Priority] = None, max_wait: Optional[float] = None):
+        """Wait until one request with the estimated number of tokens may be sent.
+
+        Args:
+            tokens: Estimated tokens of the request, capped at one minute of budget.
+            priority: Queue priority, defaults to the one set by request_priority.
+            max_wait: Maximum queue wait in seconds, defaults to max_queue_wait.
+        """
+        if self.unlimited:
+            return
+        priority = _priority.get() if priority is None else priority
+        max_wait = self.max_queue_wait if max_wait is None else max_wait
+        if self.tokens_per_minute > 0:
+            tokens = min(tokens, self.tokens_per_minute)
+
+        start = time.monotonic()
+        entry = (int(priority), next(self.__seq))
+        with self.__cond:
+            heapq.heappush(self.__waiters, entry)
+            self.__max_depth = max(self.__max_depth, len(self.__waiters))
+            try:
+                while True:
+                    self._refill()
+                    wait = self._time_until_available(tokens) if self.__waiters[0] == entry else max_wait
+                    if self.__waiters[0] == entry and wait <= 0:
+                        heapq.heappop(self.__waiters)
+                        self.__requests -= 1 if self.requests_per_minute > 0 else 0
+                        self.__tokens -= tokens if self.tokens_per_minute > 0 else 0
+                        waited = time.monotonic() - start
+                        self.__admitted += 1
+                        self.__total_wait += waited
+                        self.__recent_waits.append(waited)
+                        return
+                    remaining = start + max_wait - time.monotonic()
+                    if remaining <= 0:
+                        self.__waiters.remove(entry)
+                        heapq.heapify(self.__waiters)
+                        self.__rejected += 1
+                        raise AdmissionRejected(
+                            f"{self.name} rate limiter: not admitted within {max_wait}s "
+                            f"({len(self.__waiters)} requests queued)"
+                        )
+                    self.__cond.wait(timeout=min(remaining, wait))
+            finally:
+                self.__cond.notify_all()
+
+    def consume(self, tokens: float):
+        """Charge tokens that were only known after the call, e.g. completion tokens."""
+        if self.tokens_per_minute <= 0 or tokens <= 0:
+            return
+        with self.__cond:
+            self._refill()
+            self.__tokens -= tokens
+
+    def stats(self) -> dict:
+        with self.__cond:
+            waits = sorted(self.__recent_waits)
+            return {
+                "name": self.name,
+                "queue_depth": len(self.__waiters),
+                "max_queue_depth": self.__max_depth,
+                "admitted": self.__admitted,
+                "rejected": self.__rejected,
+                "avg_wait": self.__total_wait / self.__admitted if self.__admitted else 0.0,
+                "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "available_requests": self.__requests,
+                "available_tokens": self.__tokens,
+            }
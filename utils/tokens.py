@@ -0,0 +1,28 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import logging
+
+_encoding = None
+_encoding_loaded = False
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text.
+
+    Uses tiktoken when its encoding is available and falls back to a rough
+    estimate (one token per CJK character, four characters per token otherwise).
+    """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"tiktoken unavailable, estimating tokens: {e}")
+
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+    return cjk + (len(text) - cjk + 3) // 4